@@ -1,46 +1,71 @@
-from scene import Scene
-
-
 import numpy as np
 
 import scipy.spatial
 import random
 import math
+from collections import OrderedDict
 
-from common import str2float    # Converting CGAL string to float.
+from common import str2float, float2str    # Converting between CGAL strings and floats.
 
 class FaceFailure(Exception): pass
 
 class Feature():
+    """Features carry a geometric key, which is hashed once and gives a cheap deterministic ordering
+    (edges, then faces, then vertices, each ordered by position).
+    Equal features have equal keys; the cached hash rejects most unequal pairs before the keys are compared."""
+    __slots__ = ("key", "_hash")
+
+    def identify(self, key):
+        self.key = key
+        self._hash = hash(key)
+
     def __repr__(self): return str(self)
-    def __eq__(self,o): return str(self) == str(o)
+    def __eq__(self,o): return isinstance(o,Feature) and self._hash == o._hash and self.key == o.key
     def __ne__(self,o): return not (self == o)
-    def __hash__(self): return hash(str(self))
+    def __hash__(self): return self._hash
+    def __lt__(self,o): return self.key < o.key
+    def __gt__(self,o): return self.key > o.key
 
 class Vertex(Feature):
+    """exact: whether p holds the exact coordinates, in which case the strings are only made on demand"""
+    __slots__ = ("p", "exact", "_coordinates")
     def __init__(self,x,y=None,z=None):
         if y is None:
             x,y,z = x.x,x.y,x.z
         self.p = np.array([str2float(x),str2float(y),str2float(z)])
         # for bizarre reasons we actually need to represent these as strings
-        self.x = str(x)
-        self.y = str(y)
-        self.z = str(z)
+        self._coordinates = (str(x),str(y),str(z))
+        self.exact = False
+        self.identify((2,) + tuple(self.p.tolist()))
+
+    @staticmethod
+    def fromDoubles(x,y,z):
+        """vertex whose exact coordinates are the doubles x, y, z"""
+        v = Vertex.__new__(Vertex)
+        v.p = np.array([x,y,z], dtype=np.float64)
+        v._coordinates = None
+        v.exact = True
+        v.identify((2,) + tuple(v.p.tolist()))
+        return v
+
+    @property
+    def coordinates(self):
+        if self._coordinates is None:
+            self._coordinates = tuple(float2str(c) for c in self.p.tolist())
+        return self._coordinates
+    @property
+    def x(self): return self.coordinates[0]
+    @property
+    def y(self): return self.coordinates[1]
+    @property
+    def z(self): return self.coordinates[2]
+
+    def __reduce__(self): return (Vertex, self.coordinates)
     def child(self,o): return False
     def close(self,o,e=0.01):
         return ((self.p - o.p)*(self.p - o.p)).sum()**0.5 < e
-    def __hash__(self): return hash(tuple(list(self.p)))
-    def __eq__(self,o):
-        return isinstance(o,Vertex) and (self.p == o.p).all()
-    def __ne__(self,o):
-        return not (self == o)
     def __str__(self):
         return f"Vertex({self.x},{self.y},{self.z})"
-    def __repr__(self): return str(self)
-    def __gt__(self,o):
-        return tuple(list(self.p)) > tuple(list(o.p))
-    def __lt__(self,o):
-        return tuple(list(self.p)) < tuple(list(o.p))
     def __add__(self,o):
         if isinstance(o,Vertex):
             return Vertex(*[A + B for A,B in zip(self.p,o.p) ])
@@ -53,28 +78,26 @@ class Vertex(Feature):
         return Vertex(*[w*c for c in self.p ])
 
 class Edge(Feature):
+    __slots__ = ("e",)
     def __init__(self,u,v):
         if u > v:
             self.e = (u,v)
         else:
             self.e = (v,u)
+        self.identify((0, self.e[0].key, self.e[1].key))
+    def __reduce__(self): return (Edge, self.e)
 
     def child(self,o):
         return isinstance(o,Vertex) and o in self.e
     
-    def __hash__(self): return hash(self.e)
-    def __eq__(self,o):
-        return isinstance(o,Edge) and self.e == o.e
-    def __ne__(self,o):
-        return not (self == o)
     def __str__(self):
         return f"Edge{self.e}"
-    def __repr__(self): return str(self)
 
     def numpy(self):
         return self.e[0].p - self.e[1].p
 
 class Face(Feature):
+    __slots__ = ("cycles",)
     def __init__(self, cycles):
         if len(cycles) != 1:
             raise FaceFailure()
@@ -83,47 +106,268 @@ class Face(Feature):
                    for v in c )
         assert all( isinstance(c,frozenset) for c in cycles )
         self.cycles = tuple(cycles)
+        self.identify((1,) + tuple(tuple(sorted(v.key for v in c))
+                                   for c in self.cycles ))
+    def __reduce__(self): return (Face, (list(self.cycles),))
     def child(self,o):
         if isinstance(o,Edge): return any( o.child(v)
                                            for c in self.cycles
                                            for v in c )
         if isinstance(o,Vertex):
-            return any( e == o
-                        for c in self.cycles
-                        for e in c )
+            return any( o in c for c in self.cycles )
         return False
     def __str__(self):
         return f"Face{self.cycles}"
-    def __hash__(self):
-        return hash(self.cycles)
-    def __eq__(self,o):
-        return isinstance(o,Face) and self.cycles == o.cycles
+
+class VertexIndex():
+    """Hash grid for finding vertices within a tolerance of a point.
+    Cells are as wide as the tolerance, so anything close to a point lives in one of the 27 cells around it.
+    Among several close vertices, the one added first wins, just like scanning a list would.
+    An index can extend a parent index, which is consulted first and never modified."""
+    neighborhood = [(dx,dy,dz)
+                    for dx in (-1,0,1)
+                    for dy in (-1,0,1)
+                    for dz in (-1,0,1) ]
+    def __init__(self, vertices=[], e=0.01, parent=None):
+        self.e = e
+        self.parent = parent
+        self.cells = {}
+        self.size = 0
+        for v in vertices: self.add(v)
+
+    def __len__(self):
+        return self.size + (len(self.parent) if self.parent is not None else 0)
+
+    def cell(self, v):
+        return (math.floor(v.p[0]/self.e),
+                math.floor(v.p[1]/self.e),
+                math.floor(v.p[2]/self.e))
+
+    def add(self, v):
+        self.cells.setdefault(self.cell(v), []).append((self.size, v))
+        self.size += 1
+
+    def findClose(self, v):
+        if self.parent is not None:
+            # everything in the parent was added before anything in here
+            vp = self.parent.findClose(v)
+            if vp is not None: return vp
+        x,y,z = self.cell(v)
+        best = None
+        for dx,dy,dz in VertexIndex.neighborhood:
+            for n,vp in self.cells.get((x + dx,y + dy,z + dz), []):
+                if (best is None or n < best[0]) and v.close(vp, self.e):
+                    best = (n,vp)
+        if best is None: return None
+        return best[1]
+
+class Topology():
+    """Snapshot of the b-rep held by a Scene, fetched in bulk rather than one SWIG call per element.
+    vertices: Nx3 float64 positions, rounded from the exact coordinates; exact: Nx3 bool, true where the rounding was exact.
+    half_edges: Ex2 (source, target) vertex indices, with half_edge_twins of length E.
+    Half facet cycles are in CSR form: the cycles of facet f are facet_offsets[f]..facet_offsets[f + 1],
+    and the vertices of cycle c are cycle_vertices[cycle_offsets[c]:cycle_offsets[c + 1]]."""
+    def __init__(self, scene, use_target=False):
+        self.vertices = np.asarray(scene.GetVertexArray(use_target), dtype=np.float64).reshape(-1, 3)
+        self.exact = np.asarray(scene.GetVertexExactArray(use_target), dtype=bool).reshape(-1, 3)
+        self.half_edges = np.asarray(scene.GetHalfEdgeArray(use_target), dtype=np.int64).reshape(-1, 2)
+        self.half_edge_twins = np.asarray(scene.GetHalfEdgeTwinArray(use_target), dtype=np.int64)
+        self.facet_offsets = np.asarray(scene.GetHalfFacetOffsetArray(use_target), dtype=np.int64)
+        self.cycle_offsets = np.asarray(scene.GetCycleOffsetArray(use_target), dtype=np.int64)
+        self.cycle_vertices = np.asarray(scene.GetCycleArray(use_target), dtype=np.int64)
+        self.half_facet_twins = np.asarray(scene.GetHalfFacetTwinArray(use_target), dtype=np.int64)
+        self.normals = np.asarray(scene.GetHalfFacetNormalArray(use_target), dtype=np.float64).reshape(-1, 3)
+        self.outward = np.asarray(scene.GetHalfFacetOutwardArray(use_target), dtype=bool)
+
+    def cycles(self, f):
+        """list of vertex index arrays, one for each cycle of half facet f"""
+        return [self.cycle_vertices[self.cycle_offsets[c]:self.cycle_offsets[c + 1]]
+                for c in range(self.facet_offsets[f], self.facet_offsets[f + 1]) ]
+
+    def fingerprint(self, keys):
+        """keys: exact, hashable description of each vertex.
+        Returns a description of the b-rep which does not depend on how CGAL numbered its elements:
+        each cycle is rotated to start at its smallest vertex, and vertices and facets are sorted."""
+        facets = []
+        for f in range(len(self.facet_offsets) - 1):
+            cycles = []
+            for c in self.cycles(f):
+                c = [keys[n] for n in c.tolist()]
+                k = min(range(len(c)), key=lambda n: c[n])
+                cycles.append(tuple(c[k:] + c[:k]))
+            facets.append(tuple(sorted(cycles)))
+        return (tuple(sorted(keys)), tuple(sorted(facets)))
+
+class ExtrusionCache():
+    """Least recently used memo of CAD.extrude, holding at most `capacity` results.
+    Failed extrusions are remembered too, and their exception is raised again on a hit."""
+    def __init__(self, capacity=10000):
+        self.capacity = capacity
+        self.entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def __len__(self): return len(self.entries)
+
+    def __str__(self):
+        return f"ExtrusionCache({len(self)}/{self.capacity} entries, {self.hits} hits, {self.misses} misses)"
+
+    def get(self, key):
+        """returns None on a miss"""
+        value = self.entries.get(key)
+        if value is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        self.entries.move_to_end(key)
+        return value
+
+    def put(self, key, value):
+        self.entries[key] = value
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.capacity:
+            self.entries.popitem(last=False)
 
 class CAD():
-    """Purely functional wrapper over Scene"""
+    """Purely functional wrapper over Scene.
+    Set CAD.cache to an ExtrusionCache to memoize extrusions."""
     instrument = False
+    cache = None
     def __init__(self, child=None):
+        # imported here so that the feature classes, and everything trained from datasets, work without the extension
+        from scene import Scene
         self.child = child or Scene()
+        self._topology = None
+        self._vertices = None
+        self._vertexIndex = None
+        self._fingerprint = None
+        self._targetFingerprint = None
 
     @property
     def empty(self):
         return self.child.GetSceneVertexNumber() == 0
 
+    @property
+    def topology(self):
+        """bulk snapshot of the canvas, computed once since the scene never changes underneath us"""
+        if self._topology is None:
+            self._topology = Topology(self.child)
+        return self._topology
+
+    @staticmethod
+    def vertexKey(v):
+        """exact, hashable description of a vertex"""
+        return (v.key, () if v.exact else v.coordinates)
+
+    @staticmethod
+    def vertexStrings(scene, topology, use_target=False):
+        """exact x, y, z strings of every vertex, fetched in one call;
+        only vertices which are not exactly doubles need them, so this is empty when there are none"""
+        if topology.exact.all(): return []
+        return scene.GetVertexStringArray(use_target)
+
+    @property
+    def fingerprint(self):
+        """canonical description of the canvas; equal canvases have equal fingerprints"""
+        if self._fingerprint is None:
+            self._fingerprint = self.topology.fingerprint([CAD.vertexKey(v) for v in self.getVertices()])
+        return self._fingerprint
+
+    @property
+    def targetFingerprint(self):
+        """canonical description of the target, which regularization snaps the canvas to"""
+        if self._targetFingerprint is None:
+            t = Topology(self.child, use_target=True)
+            strings = CAD.vertexStrings(self.child, t, use_target=True)
+            keys = [((2,) + tuple(p), () if all(exact) else tuple(strings[3*n:3*n + 3]))
+                    for n,(p,exact) in enumerate(zip(t.vertices.tolist(), t.exact.tolist())) ]
+            self._targetFingerprint = t.fingerprint(keys)
+        return self._targetFingerprint
+
+    def cloneForThread(self):
+        """copy that can be extruded on another thread while this one is in use; slower than the copies extrude makes,
+        so only use it to hand work to a thread pool"""
+        result = CAD(self.child.CloneForThread())
+        result._fingerprint = self._fingerprint
+        result._targetFingerprint = self._targetFingerprint
+        return result
+
     def extrude(self, face, direction, union=True):
+        """face: list of Vertex's or of coordinate triples.
+        When every vertex is exactly a double the extrusion goes to CGAL as doubles, otherwise as a command string.
+        Numbers are spelled out exactly in the string, so both routes build the same geometry."""
+        if CAD.cache is None:
+            return self._extrude(face, direction, union)
+
+        number = lambda c: c if isinstance(c,str) else float(c)
+        command = (tuple(CAD.vertexKey(v) if isinstance(v,Vertex) else tuple(number(c) for c in v)
+                         for v in face),
+                   tuple(number(c) for c in direction),
+                   union)
+        key = (self.targetFingerprint, self.fingerprint, command)
+        result = CAD.cache.get(key)
+        if result is None:
+            try:
+                result = self._extrude(face, direction, union)
+            except RuntimeError as exception:
+                result = exception
+            CAD.cache.put(key, result)
+        if isinstance(result, RuntimeError):
+            raise result
+        return result
+
+    def _extrude(self, face, direction, union):
         s = self.child.Clone()
+        op = '+' if union else '-'
+        if CAD.instrument:
+            print(CAD.extrusionCommand(face, direction, union))
+        if all( isinstance(v,Vertex) and v.exact for v in face ):
+            s.ExtrudeFromData([c for v in face for c in v.p.tolist()],
+                              [float(c) for c in direction],
+                              op)
+        else:
+            s.ExtrudeFromString(CAD.extrusionCommand(face, direction, union))
+        result = CAD(s)
+        # the clone shares our target
+        result._targetFingerprint = self._targetFingerprint
+        return result
+
+    def extrudeAll(self, extrusions, syncEach=False):
+        """extrusions: list of (face, direction, union), applied one after the other in a single call to CGAL.
+        An extrusion that fails is skipped. Returns the resulting CAD and, for each extrusion, whether it was applied."""
+        extrusions = list(extrusions)
+        if not extrusions: return self, []
+        s = self.child.Clone()
+        if CAD.instrument:
+            for face, direction, union in extrusions:
+                print(CAD.extrusionCommand(face, direction, union))
+        if all( isinstance(v,Vertex) and v.exact for face,_,_ in extrusions for v in face ):
+            polygons, offsets, directions = [], [0], []
+            for face, direction, _ in extrusions:
+                polygons.extend(c for v in face for c in v.p.tolist())
+                offsets.append(len(polygons))
+                directions.extend(float(c) for c in direction)
+            codes = s.ExtrudeFromDataArray(polygons, offsets, directions,
+                                           "".join('+' if union else '-' for _,_,union in extrusions),
+                                           syncEach)
+        else:
+            codes = s.ExtrudeFromStrings([CAD.extrusionCommand(*e) for e in extrusions], syncEach)
+        result = CAD(s)
+        result._targetFingerprint = self._targetFingerprint
+        return result, [bool(c) for c in codes]
+
+    @staticmethod
+    def extrusionCommand(face, direction, union=True):
         command = []
-        for cs in face + [direction]:
+        for cs in list(face) + [direction]:
+            if isinstance(cs,Vertex): cs = cs.coordinates
             for c in cs:
-                command.append(str(c))
+                command.append(float2str(c))
         if union:
             command.append('+')
         else:
             command.append('-')
-        command = " ".join(["extrude"] + command)
-        if CAD.instrument:
-            print(command)
-        s.ExtrudeFromString(command)
-        return CAD(s)
+        return " ".join(["extrude"] + command)
 
     def export(self, fn):
         try:
@@ -132,36 +376,34 @@ class CAD():
             print("really sorry about this but I had trouble saving the file",fn,"which means may be the geometries weird")
 
     def findClose(self, v):
-        candidates = [vp for vp in self.getVertices()
-                      if v.close(vp)]
-        if candidates: return candidates[0]
-        return None
+        if self._vertexIndex is None:
+            self._vertexIndex = VertexIndex(self.getVertices())
+        return self._vertexIndex.findClose(v)
 
 
     def getVertices(self):
-        N = self.child.GetSceneVertexNumber()
-        return [Vertex(v.x,v.y,v.z)
-                for n in range(N)
-                for v in [self.child.GetSceneVertex(n)] ]
+        if self._vertices is None:
+            t = self.topology
+            strings = CAD.vertexStrings(self.child, t)
+            self._vertices = [Vertex.fromDoubles(*p) if all(exact) else Vertex(*strings[3*n:3*n + 3])
+                              for n,(p,exact) in enumerate(zip(t.vertices.tolist(), t.exact.tolist())) ]
+        return list(self._vertices)
 
     def getEdges(self):
-        return list({Edge(Vertex(self.child.GetSceneVertex(e.source)),
-                          Vertex(self.child.GetSceneVertex(e.target)))
-                     for n in range(self.child.GetSceneHalfEdgeNumber())
-                     for e in [self.child.GetSceneHalfEdge(n)] })
+        vs = self.getVertices()
+        return list({Edge(vs[source], vs[target])
+                     for source, target in self.topology.half_edges.tolist() })
 
     def getFaces(self):
+        t = self.topology
+        vs = self.getVertices()
+        facet_offsets = t.facet_offsets.tolist()
+        cycle_offsets = t.cycle_offsets.tolist()
+        cycle_vertices = t.cycle_vertices.tolist()
         fs = set()
-        for n in range(self.child.GetSceneHalfFacetNumber()):
-            f = self.child.GetSceneHalfFacet(n)
-            cycles = []
-            for cycle in f.cycles:
-                thisCycle = []
-                for v in cycle:                
-                    v = Vertex(self.child.GetSceneVertex(v))
-                    thisCycle.append(v)
-                    
-                cycles.append(frozenset(thisCycle))
+        for n in range(len(facet_offsets) - 1):
+            cycles = [frozenset(vs[v] for v in cycle_vertices[cycle_offsets[c]:cycle_offsets[c + 1]])
+                      for c in range(facet_offsets[n], facet_offsets[n + 1]) ]
             fs.add(Face(cycles))
         return fs
     
@@ -189,6 +431,12 @@ class CAD():
 
     def setTarget(self, c):
         self.child.SetTargetFromOtherScene(c.child)
+        # regularizing against the target renumbers everything
+        self._topology = None
+        self._vertices = None
+        self._vertexIndex = None
+        self._fingerprint = None
+        self._targetFingerprint = None
         
             
 
@@ -247,7 +495,7 @@ class Extrusion():
         return compilation
 
     def execute(self,c):
-        return c.extrude([(v.x,v.y,v.z) for v in self.vertices],
+        return c.extrude(self.vertices,
                          self.displacement,
                          self.union)
 
@@ -263,14 +511,13 @@ class Extrusion():
             faceID = 0
         else:
             faceID = random.choice(range(c.child.GetSceneHalfFacetNumber()))
-        f = c.child.GetSceneHalfFacet(faceID)
         polygon = c.child.GenerateRandomPolygon(faceID, 0.5, 0.5, False)
         vertices = polygon.strip().split()
         vertices = [Vertex(vertices[3*i],vertices[3*i + 1],vertices[3*i + 2])
                     for i in range(len(vertices)//3)]
         
-        normal = np.asarray([str2float(v) for v in f.normal.split()])
-        if not f.outward: normal = -normal
+        normal = c.topology.normals[faceID]
+        if not c.topology.outward[faceID]: normal = -normal
         L = ((normal*normal).sum()**0.5)
         if L < 0.001:
             print("for some reason the normal is nothing")
@@ -288,7 +535,10 @@ class Program():
         self.commands = commands
 
     def execute(self,c):
-        for k in self.commands: c = k.execute(c)
+        # the whole program in one call to CGAL, which only syncs the canvas at the end
+        c, applied = c.extrudeAll([(k.vertices, k.displacement, k.union) for k in self.commands])
+        if not all(applied):
+            raise RuntimeError(f"command {applied.index(False)} of {self} failed")
         return c
 
     def compile(self, target=None, canvas=None):
@@ -7,14 +7,95 @@ from state import *
 import os
 import time
 
+import scipy.sparse
+
 import torch.nn.functional as F
 import torch
 import torch.nn as nn
 #from torch.nn.modules.transformer import TransformerEncoder, TransformerEncoderLayer, LayerNorm
 from transformer import TransformerEncoder
 
+class Featurization():
+    """What the agent sees of a state, as arrays.
+    features: the canvas and target features in order (None when loaded from a dataset), and index: feature -> position
+    X: one row per feature: [is vertex, is edge, is face, on canvas, on target], then xyz for vertices, then one column per tag.
+    Rows are as wide as needed (at most 11) and get padded to the model dimension when encoded.
+    incidence: Px2 pairs (i, j) of distinct features where one contains the other, listed in both directions
+    codes: for each pair, the index of its relationship in BoundaryEncoder.edgeCode"""
+    width = 8 + len(ALL_TAGS)
+
+    def __init__(self, features, X, incidence, codes, index=None):
+        self.features, self.X, self.incidence, self.codes = features, X, incidence, codes
+        if index is None and features is not None:
+            index = {f: i for i,f in enumerate(features) }
+        self.index = index
+
+    def __len__(self): return len(self.X)
+
+    @staticmethod
+    def ofState(state):
+        fs = sorted(state.canvas_features|state.target_features)
+        index = {f: i for i,f in enumerate(fs) }
+        vertices = [i for i,f in enumerate(fs) if isinstance(f,Vertex) ]
+        edges = [i for i,f in enumerate(fs) if isinstance(f,Edge) ]
+        faces = [i for i,f in enumerate(fs) if isinstance(f,Face) ]
+
+        X = np.zeros((len(fs), Featurization.width), dtype=np.float32)
+        X[vertices,0] = 1
+        X[edges,1] = 1
+        X[faces,2] = 1
+        X[:,3] = [f in state.canvas_features for f in fs]
+        X[:,4] = [f in state.target_features for f in fs]
+        if vertices:
+            X[vertices,5:8] = np.stack([fs[i].p for i in vertices])
+        # tags come right after the coordinates for vertices, and right after the membership bits otherwise
+        for f,tags in state.tags.items():
+            i = index.get(f)
+            if i is None: continue
+            offset = 8 if isinstance(f,Vertex) else 5
+            for t in tags:
+                X[i,offset + ALL_TAGS.index(t)] = 1
+
+        # sparse incidence from each edge and face to the vertices it contains
+        def incidence(parents, children):
+            rows, columns = [], []
+            for row,i in enumerate(parents):
+                for v in children(fs[i]):
+                    j = index.get(v)
+                    if j is not None:
+                        rows.append(row)
+                        columns.append(j)
+            return scipy.sparse.csr_matrix((np.ones(len(rows)), (rows, columns)),
+                                           shape=(len(parents), len(fs)))
+        ev = incidence(edges, lambda e: e.e)
+        fv = incidence(faces, lambda f: {v for c in f.cycles for v in c })
+        # a face contains an edge when it contains either of its vertices
+        fe = (fv @ ev.T).tocoo()
+
+        pairs, codes = [], []
+        edgeCode = BoundaryEncoder.edgeCode
+        for m,parents,children,source,destination in [(ev.tocoo(), edges, None, "e", "v"),
+                                                       (fv.tocoo(), faces, None, "f", "v"),
+                                                       (fe, faces, edges, "f", "e")]:
+            i = np.asarray(parents, dtype=np.int64)[m.row]
+            j = m.col if children is None else np.asarray(children, dtype=np.int64)[m.col]
+            pairs.extend([np.stack([i,j],1), np.stack([j,i],1)])
+            codes.extend([np.full(len(i), edgeCode.index(source + "2" + destination)),
+                          np.full(len(i), edgeCode.index(destination + "2" + source))])
+
+        return Featurization(fs, X,
+                             np.concatenate(pairs).astype(np.int64).reshape(-1, 2),
+                             np.concatenate(codes).astype(np.int64),
+                             index)
+
+    def mask(self):
+        """NxN: 1 for features that are the same or incident"""
+        mask = np.eye(len(self))
+        mask[self.incidence[:,0],self.incidence[:,1]] = 1.
+        return mask
+
 class Agent(Module):
-    backends = ["gnn","transformer","alternate","torch_transformer","random"]
+    backends = ["gnn","sparse_gnn","transformer","alternate","torch_transformer","random"]
     def __init__(self, backend="gnn"):
         super(Agent, self).__init__()
         self.d_model = 64
@@ -34,7 +115,7 @@ class Agent(Module):
                                             dropout=0.0,
                                             activation="relu")
             self.encoder = TransformerEncoder(layer, layers, LayerNorm(self.d_model))
-        elif backend == "gnn":
+        elif backend in {"gnn","sparse_gnn"}:
             self.encoder = BoundaryEncoder(layers=layers, H=self.d_model)
         elif backend == "random":
             self.encoder = None
@@ -47,80 +128,108 @@ class Agent(Module):
 
         self.finalize()
 
-    def forward(self, state):
-        def vectorize(f):
-            if isinstance(f,Vertex):
-                return [1,0,0,int(f in state.canvas_features),int(f in state.target_features)] + \
-                    list(f.p)
-            if isinstance(f,Edge):
-                return [0,1,0,int(f in state.canvas_features),int(f in state.target_features)]
-            if isinstance(f,Face):
-                return [0,0,1,int(f in state.canvas_features),int(f in state.target_features)]
-
-        fs = list(sorted(list(state.canvas_features|state.target_features),
-                         key=str))
-        mask = np.zeros((len(fs),len(fs)))
-        relationship = [["disconnected" for _ in range(len(fs)) ]
-                        for _ in range(len(fs)) ]
-
-        X = []
-
-        for i,f in enumerate(fs):
-            v = vectorize(f)
-            v.extend([float(int(t in state.tags[f])) for t in ALL_TAGS ])
-            v = v + [0.]*(self.d_model - len(v))
-            X.append(v)
-
-            for j,fp in enumerate(fs):
-                if i == j or f.child(fp) or fp.child(f):
-                    mask[i,j] = 1.
-                    mask[j,i] = 1.
-                if f.child(fp) or fp.child(f):
-                    source = {Face: "f",Edge: "e",Vertex: "v"}[f.__class__]
-                    destination = {Face: "f",Edge: "e",Vertex: "v"}[fp.__class__]
-                    relationship[i][j] = source + "2" + destination
-                    relationship[j][i] = destination + "2" + source
-
-        X = self.tensor(X).unsqueeze(0)
-        mask = self.tensor(mask).unsqueeze(0)
+    def featurize(self, state):
+        """computed once per state, and cached on it, so that forward, loss and sample share it"""
+        if state.featurization is None:
+            state.featurization = Featurization.ofState(state)
+        return state.featurization
+
+    def encode(self, featurization):
+        """returns log probabilities over (feature, action) pairs, as a [number of features] x [number of actions] matrix"""
+        return self.encodeBatch([featurization]).squeeze(0)
+
+    def encodeBatch(self, featurizations):
+        """Encodes several states at once by padding them to the largest one.
+        returns: B x [most features] x [number of actions] log probabilities, which are -inf for padding"""
+        B = len(featurizations)
+        lengths = [len(f) for f in featurizations]
+        N = max(lengths)
+        X = np.zeros((B, N, self.d_model), dtype=np.float32)
+        valid = np.zeros((B, N))
+        for b,f in enumerate(featurizations):
+            X[b,:len(f),:f.X.shape[1]] = f.X
+            valid[b,:len(f)] = 1
+        X = self.tensor(X)
 
         if self.backend == "transformer":
-            encodings = self.encoder(X, [X.size(1)], mask=mask).squeeze(0)
+            # padding attends only to itself, so that no row of attention is empty
+            mask = np.tile(np.eye(N), (B,1,1))
+            for b,f in enumerate(featurizations):
+                mask[b,:len(f),:len(f)] = f.mask()
+            encodings = self.encoder(X, lengths, mask=self.tensor(mask))
         elif self.backend == "gnn":
-            encodings = self.encoder(X.squeeze(0), relationship)
+            codes = BoundaryEncoder.codeMatrix(N,
+                                               np.concatenate([f.incidence for f in featurizations ]),
+                                               np.concatenate([f.codes for f in featurizations ]),
+                                               batch=np.concatenate([np.full(len(f.codes), b)
+                                                                     for b,f in enumerate(featurizations) ]),
+                                               B=B, device=X.device)
+            encodings = self.encoder(X, codes, mask=self.tensor(valid))
+        elif self.backend == "sparse_gnn":
+            # the states become one graph with many components, and only incident pairs exchange explicit messages
+            offsets = np.cumsum([0] + lengths)
+            incidence = np.concatenate([f.incidence + offsets[b] for b,f in enumerate(featurizations) ])
+            codes = np.concatenate([f.codes for f in featurizations ])
+            graph = np.concatenate([np.full(len(f), b) for b,f in enumerate(featurizations) ])
+            valid_ = self.tensor(valid) > 0
+            encodings = self.encoder.sparseForward(X[valid_], incidence, codes, graph)
+            encodings = torch.zeros(B, N, encodings.size(-1), device=encodings.device).masked_scatter(valid_.unsqueeze(-1), encodings)
         else:
             assert False, "pytorch transformer deprecated/nonsupported"
         yh = self.predict(encodings)
-        number_objects, number_predictions = yh.shape
-        yh = yh.contiguous().view(-1)
-        yh = F.log_softmax(yh,dim=-1).contiguous().view(number_objects,number_predictions)
+        _, _, number_predictions = yh.shape
+        yh = yh.masked_fill(self.tensor(valid).unsqueeze(-1) == 0, NEGATIVEINFINITY)
+        yh = yh.contiguous().view(B, -1)
+        yh = F.log_softmax(yh,dim=-1).contiguous().view(B, N, number_predictions)
         return yh
 
+    def forward(self, state):
+        return self.encode(self.featurize(state))
+
     def loss(self, state, action):
-        yh = self(state)
-        action_index, feature = action.code()
-        feature = state.findClose(feature)
-        fs = list(sorted(list(state.canvas_features|state.target_features),
-                         key=str))
-        feature_index = fs.index(feature)
+        return self.codedLoss(*self.code(state, action))
 
+    def codedLoss(self, featurization, feature_index, action_index):
+        """loss of an action given as indices, which is how datasets store them"""
+        yh = self.encode(featurization)
         return -yh[feature_index,action_index]
 
-    def sample(self, state):
-        yh = self(state)
-        axis1, axis2 = yh.size()
-        i = self.to_numpy(torch.distributions.categorical.Categorical(probs=torch.exp(yh).view(-1)).sample())
-        fs = list(sorted(list(state.canvas_features|state.target_features),
-                         key=str))
-        # axis2: number of actions
-        # axis1: number of objects
-        code = (i%axis2, fs[i//axis2])
+    def batchedLoss(self, examples):
+        """examples: list of (featurization, feature index, action index), possibly from several trajectories.
+        returns the average loss, computed with one forward pass over the padded batch"""
+        yh = self.encodeBatch([f for f,_,_ in examples])
+        features = self.tensor([feature_index for _,feature_index,_ in examples])
+        actions = self.tensor([action_index for _,_,action_index in examples])
+        return -yh[torch.arange(len(examples), device=yh.device),features,actions].mean()
+
+    def code(self, state, action):
+        """the action as (featurization, feature index, action index), which is what batchedLoss takes"""
+        featurization = self.featurize(state)
+        action_index, feature = action.code()
+        return featurization, featurization.index[state.findClose(feature)], action_index
+
+    @staticmethod
+    def decode(action_index, feature):
         codeToAction = {
             0: lambda v: NextVertex(v),
             1: lambda v: Extrude(v, False),
             2: lambda v: Extrude(v, True)
             }
-        return codeToAction[code[0]](code[1])
+        return codeToAction[action_index](feature)
+
+    def sample(self, state):
+        return self.sampleBatch([state])[0]
+
+    def sampleBatch(self, states):
+        """one action for each state, sampled from a single padded forward pass"""
+        featurizations = [self.featurize(s) for s in states]
+        yh = self.encodeBatch(featurizations)
+        # axis2: number of actions
+        # axis1: number of objects
+        B, axis1, axis2 = yh.size()
+        i = torch.distributions.categorical.Categorical(probs=torch.exp(yh).view(B, -1)).sample()
+        return [Agent.decode(i%axis2, f.features[i//axis2])
+                for f,i in zip(featurizations, i.tolist()) ]
 
     def rollout(self, spec, maximumLength):
         states = [State(CAD(), spec)]
@@ -135,16 +244,78 @@ class Agent(Module):
         return states, actions
 
     def rollouts(self, spec, maximumLength, N):
+        """N particles advanced in lockstep, with one forward pass per step for all of them.
+        A particle retires when its action fails, or once it has reconstructed the target, which ends the search"""
+        initial = State(CAD(), spec)
+        particles = [([initial], []) for _ in range(N) ]
+        live = particles
+        for _ in range(maximumLength):
+            if not live: break
+            survivors = []
+            for (states, actions), a in zip(live, self.sampleBatch([states[-1] for states,_ in live ])):
+                try:
+                    actions.append(a)
+                    states.append(a(states[-1]))
+                except: continue
+                if states[-1].iou() >= 1.: return states, actions
+                survivors.append((states, actions))
+            live = survivors
+
         best = None
-        for _ in range(N):
-            states, actions = self.rollout(spec, maximumLength)
+        for states, actions in particles:
             iou = states[-1].iou()
             if best is None or iou > best[0]:
                 best = (iou,states,actions)
-        return best[1:]            
-                
-        
-        
+        return best[1:]
+
+    def search(self, spec, maximumLength, branching=5, nodes=1000, timeout=None):
+        """Best-first search over action sequences.
+        Partial sequences are scored by their cumulative log probability plus the IoU of their canvas,
+        and expanding one tries its `branching` most likely actions.
+        States which only differ in how they were reached are expanded once.
+        Stops on a perfect reconstruction, or after expanding `nodes` states or spending `timeout` seconds.
+        returns the states and actions leading to the best IoU seen"""
+        startTime = time.time()
+        initial = State(CAD(), spec)
+        best = (initial.iou(), [initial], [])
+        seen = {Agent.searchKey(initial)}
+        q = PQ()
+        q.push(best[0], (0., [initial], []))
+        expanded = 0
+        while len(q) > 0 and expanded < nodes and \
+              (timeout is None or time.time() - startTime < timeout):
+            logLikelihood, states, actions = q.popMaximum()
+            expanded += 1
+            if len(actions) >= maximumLength: continue
+
+            featurization = self.featurize(states[-1])
+            yh = self.encode(featurization)
+            _, number_actions = yh.size()
+            yh = yh.view(-1)
+            values, indices = yh.topk(min(branching, yh.size(0)))
+            for l,i in zip(values.tolist(), indices.tolist()):
+                a = Agent.decode(i%number_actions, featurization.features[i//number_actions])
+                try:
+                    s = a(states[-1])
+                except: continue
+                key = Agent.searchKey(s)
+                if key in seen: continue
+                seen.add(key)
+
+                iou = s.iou()
+                if iou > best[0]:
+                    best = (iou, states + [s], actions + [a])
+                    if iou >= 1.: return best[1:]
+                q.push(logLikelihood + l + iou, (logLikelihood + l, states + [s], actions + [a]))
+        return best[1:]
+
+    @staticmethod
+    def searchKey(state):
+        """equal for states which behave the same from now on"""
+        return (state.canvas.fingerprint,
+                frozenset(state.tags.items()),
+                tuple(state.extrude_vertices))
+
 def makeExample(referenceProgram=None, N=2):        
     while True:
         try:
@@ -175,18 +346,39 @@ if __name__ == "__main__":
     parser.add_argument("--numberExtrusions","-n",default=2,type=int)
     parser.add_argument("--particles","-p",default=1,type=int)
     parser.add_argument("--load","-l",default=None)
-    parser.add_argument("--backend","-b",default="gnn",choices=Agent.backends)
+    parser.add_argument("--backend","-b",default="gnn",choices=Agent.backends,
+                        help="sparse_gnn is a gnn that approximates the messages of disconnected features by their mean, "
+                        "in time linear in the size of the b-rep; its checkpoints are not interchangeable with gnn ones")
     parser.add_argument("--save","-s",default=None)
     parser.add_argument("--test","-t",default=False,action='store_true')
     parser.add_argument("--memorize","-m",default=False,action='store_true')
+    parser.add_argument("--workers","-w",default=0,type=int,
+                        help="generate training examples in this many background processes")
+    parser.add_argument("--batchSize",default=1,type=int,
+                        help="number of trajectories per gradient step, whose states are all encoded in one padded batch")
+    parser.add_argument("--dataset","-d",default=None,
+                        help="train from a dataset directory built by dataset.py, instead of generating examples")
+    parser.add_argument("--search",default=False,action='store_true',
+                        help="when testing, decode with best-first search instead of sampling particles")
+    parser.add_argument("--branching",default=5,type=int,
+                        help="best-first search tries this many of the most likely actions from each state")
+    parser.add_argument("--nodes",default=1000,type=int,
+                        help="best-first search expands at most this many states")
+    parser.add_argument("--timeout",default=None,type=float,
+                        help="best-first search gives up after this many seconds")
+    parser.add_argument("--cache",default=0,type=int,
+                        help="memoize up to this many extrusions (0 disables the cache)")
     
     arguments = parser.parse_args()
 
+    if arguments.cache > 0:
+        CAD.cache = ExtrusionCache(arguments.cache)
+
     if arguments.load:
         m = torch.load(arguments.load)
     else:
         assert not arguments.test, "you need to tell me what checkpoint to load if you are testing"
-        m = Agent()
+        m = Agent(arguments.backend)
 
     if not arguments.test:
         O = torch.optim.Adam(m.parameters(), lr=0.0001)
@@ -196,28 +388,33 @@ if __name__ == "__main__":
         losses = []
         if arguments.memorize:
             states, actions, t, p = makeExample(Program.couch())
+        elif arguments.dataset:
+            from dataset import TrajectoryDataset
+            dataset = TrajectoryDataset(arguments.dataset)
+        elif arguments.workers > 0:
+            from producer import ExampleProducer
+            producer = ExampleProducer(N=arguments.numberExtrusions, workers=arguments.workers)
+            trajectories = iter(producer)
         while True:
             startTime = time.time()
             # make a training set of actions/states
-            if not arguments.memorize:
-                states, actions, t, p = makeExample(N=arguments.numberExtrusions)
+            examples = []
+            for _ in range(arguments.batchSize):
+                if arguments.memorize: pass
+                elif arguments.dataset:
+                    examples.extend(dataset.sample())
+                    continue
+                elif arguments.workers > 0:
+                    # time spent waiting on the workers
+                    states, actions = next(trajectories)
+                else:
+                    states, actions, t, p = makeExample(N=arguments.numberExtrusions)
+                examples.extend(m.code(s, a) for s,a in zip(states,actions))
             timeMakingExamples += (time.time() - startTime)
 
-            if False:
-                print("Training on the following program:")
-                print(p)
-                print("which gives the following target:")
-                print(t)
-                print("and has the following actions:")
-                for a in actions:
-                    print(a)
-
             startTime = time.time()
             m.zero_grad()
-            L = 0
-            for a,s in zip(actions,states):
-                L += m.loss(s, a)
-            L = L/len(actions)
+            L = m.batchedLoss(examples)
             L.backward()
             O.step()
             modelTime += (time.time() - startTime)
@@ -228,6 +425,8 @@ if __name__ == "__main__":
                 losses = []
                 print(f"Total graphics time: {timeMakingExamples}")
                 print(f"Total model time: {modelTime}")
+                if CAD.cache is not None:
+                    print(CAD.cache)
 
                 if arguments.save:
                     torch.save(m,arguments.save)
@@ -252,7 +451,11 @@ if __name__ == "__main__":
                 CAD.instrument = True
                 print("about to do a rollout")
                 with torch.no_grad():
-                    states, actions = m.rollouts(t,len(actions),arguments.particles)
+                    if arguments.search:
+                        states, actions = m.search(t,len(actions),arguments.branching,
+                                                   nodes=arguments.nodes, timeout=arguments.timeout)
+                    else:
+                        states, actions = m.rollouts(t,len(actions),arguments.particles)
                 print("successfully rolled")
                 CAD.instrument = False                
                 State.exportTrace(states, actions, f"data/{prefix}/{n}_")
@@ -261,6 +464,8 @@ if __name__ == "__main__":
             print("intersection-over-unions",IOUs)
             print("average",sum(IOUs)/len(IOUs))
             print("success fraction",sum(iou >= 1. for iou in IOUs )/len(IOUs))
+            if CAD.cache is not None:
+                print(CAD.cache)
                 
                 
         
@@ -9,9 +9,20 @@ def print_info(*message):
     print('\033[93m', *message, '\033[0m')
 
 def str2float(string):
-    try:
-        f = float(string)
-    except:
-        a, b = string.strip().split('/')
-        f = float(int(a) / int(b))
-    return f
\ No newline at end of file
+    if not isinstance(string, str):
+        return float(string)
+    if '/' in string:
+        a, b = string.split('/')
+        return int(a) / int(b)
+    return float(string)
+
+# The inverse of str2float: a string that CGAL reads back as exactly the same number.
+def float2str(f):
+    if isinstance(f, str):
+        return f
+    if isinstance(f, int):
+        return str(f)
+    a, b = float(f).as_integer_ratio()
+    if b == 1:
+        return str(a)
+    return '%d/%d' % (a, b)
\ No newline at end of file
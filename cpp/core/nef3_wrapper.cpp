@@ -1,7 +1,12 @@
 #include "core/nef3_wrapper.h"
+#include <algorithm>
+#include <type_traits>
+#include <unordered_map>
+#include "boost/functional/hash.hpp"
 #include "CGAL/AABB_tree.h"
 #include "CGAL/AABB_traits.h"
 #include "CGAL/AABB_face_graph_triangle_primitive.h"
+#include "CGAL/Unique_hash_map.h"
 #include "core/common.h"
 #include "core/file_helper.h"
 #include "core/triangulation.h"
@@ -50,6 +55,36 @@ static const bool CanPermute(const std::vector<std::vector<int>>& cycles1, const
     return true;
 }
 
+// Hash of the exact coordinates: equal points always land in the same bucket, but callers still compare exactly.
+static const std::size_t HashPoint(const Point_3& point) {
+    std::size_t seed = 0;
+    boost::hash_combine(seed, CGAL::to_double(point.x().exact()));
+    boost::hash_combine(seed, CGAL::to_double(point.y().exact()));
+    boost::hash_combine(seed, CGAL::to_double(point.z().exact()));
+    return seed;
+}
+
+// Two facets that CanPermute share the same key: every cycle is rotated to its lexicographically smallest
+// rotation, the cycles are sorted, and the result is flattened with each cycle prefixed by its length.
+static const std::vector<int> FacetKey(const std::vector<std::vector<int>>& cycles) {
+    std::vector<std::vector<int>> canonical;
+    for (const auto& cycle : cycles) {
+        std::vector<int> best = cycle, rotated = cycle;
+        for (int i = 1; i < static_cast<int>(cycle.size()); ++i) {
+            std::rotate(rotated.begin(), rotated.begin() + 1, rotated.end());
+            if (rotated < best) best = rotated;
+        }
+        canonical.push_back(best);
+    }
+    std::sort(canonical.begin(), canonical.end());
+    std::vector<int> key;
+    for (const auto& cycle : canonical) {
+        key.push_back(static_cast<int>(cycle.size()));
+        key.insert(key.end(), cycle.begin(), cycle.end());
+    }
+    return key;
+}
+
 const bool Nef3Wrapper::IsOutwardHalfFacet(const int fid, const int vc_idx) const {
     // Step 1: BVH.
     Polyhedron poly;
@@ -122,12 +157,6 @@ void Nef3Wrapper::Load(const std::string& file_name) {
 }
 
 void Nef3Wrapper::SyncDataStructure() {
-    std::ostringstream oss;
-    oss << poly_;
-    const std::vector<std::string> lines = SplitString(oss.str(), '\n');
-
-    // Now construct the data structure. The code below is quite inefficient. However, since we are almost always
-    // dealing with tiny scenes, I think the inefficiency is tolerable.
     vertices_.clear();
     const int vertex_num = static_cast<int>(poly_.number_of_vertices());
     vertices_.reserve(vertex_num);
@@ -135,6 +164,7 @@ void Nef3Wrapper::SyncDataStructure() {
     for (v_iter = poly_.vertices_begin(); v_iter != poly_.vertices_end(); ++v_iter) {
         vertices_.push_back(v_iter->point());
     }
+    BuildVertexIndex();
 
     half_edges_.clear();
     half_edge_twins_.clear();
@@ -147,121 +177,42 @@ void Nef3Wrapper::SyncDataStructure() {
         const int target_idx = GetVertexIndex(e_iter->target()->point());
         half_edges_.push_back(std::make_pair(source_idx, target_idx));
     }
+    BuildHalfEdgeIndex();
     // Construct the twin edges.
     for (int i = 0; i < half_edge_num; ++i) {
-        half_edge_twins_[i] = GetHalfEdgeIndex(half_edges_[i].second, half_edges_[i].first);
+        half_edge_twins_.push_back(GetHalfEdgeIndex(half_edges_[i].second, half_edges_[i].first));
     }
 
-    // Construct the face not from the polyhedron but from the file (CGAL's data structure is quite hard to understand...).
+    // Construct the faces by walking the sphere maps. The indices follow the iteration order of poly_, which is
+    // also the order in which CGAL numbers vertices and facets when writing a Nef polyhedron.
     half_facets_.clear();
     half_facet_twins_.clear();
     const int half_facet_num = static_cast<int>(poly_.number_of_halffacets());
     half_facets_.reserve(half_facet_num);
-    half_facet_twins_.resize(half_facet_num, -1);
-
-    // Now parse the input file.
-    int line_idx = 0;
-    int shalf_edge_num = 0;
-    int volume_num = 0;
-    std::vector<int> shalf_edge_to_vertex;
-    int vertex_begin = 0;
-    int half_edge_begin = 0;
-    int half_facet_begin = 0;
-    int volume_begin = 0;
-    int shalf_edge_begin = 0;
-    std::vector<std::vector<int>> shalf_edge_in_half_facets(half_facet_num);
-    std::vector<int> shalf_edge_next;
-    for (const auto& line : lines) {
-        if (line_idx < 2) {
-            // Header. Do nothing.
-        } else if (line_idx == 2) {
-            CheckError(StartsWith(line, "vertices"), "Expect to see vertices.");
-            CheckError(std::stoi(SplitString(line)[1]) == vertex_num, "Inconsistent vertex number.");
-        } else if (line_idx == 3) {
-            CheckError(StartsWith(line, "halfedges"), "Expect to see halfedges.");
-            CheckError(std::stoi(SplitString(line)[1]) == half_edge_num, "Inconsistent halfedge number.");
-        } else if (line_idx == 4) {
-            CheckError(StartsWith(line, "facets"), "Expect to see facets.");
-            CheckError(std::stoi(SplitString(line)[1]) == half_facet_num, "Inconsistent facets number.");
-        } else if (line_idx == 5) {
-            CheckError(StartsWith(line, "volumes"), "Expect to see volumes.");
-            volume_num = std::stoi(SplitString(line)[1]);
-        } else if (line_idx == 6) {
-            CheckError(StartsWith(line, "shalfedges"), "Expect to see shalfedges.");
-            shalf_edge_num = std::stoi(SplitString(line)[1]);
-            shalf_edge_to_vertex.clear();
-            shalf_edge_to_vertex.resize(shalf_edge_num, -1);
-            shalf_edge_next.clear();
-            shalf_edge_next.resize(shalf_edge_num, -1);
-        } else if (line_idx == 7) {
-            CheckError(StartsWith(line, "shalfloops"), "Expect to see shalfloops.");
-        } else if (line_idx == 8) {
-            CheckError(StartsWith(line, "sfaces"), "Expect to see sfaces.");
-            vertex_begin = 9;
-            half_edge_begin = vertex_begin + vertex_num;
-            half_facet_begin = half_edge_begin + half_edge_num;
-            volume_begin = half_facet_begin + half_facet_num;
-            shalf_edge_begin = volume_begin + volume_num;
-        } else if (line_idx >= vertex_begin && line_idx < half_edge_begin) {
-            // Parse vertices.
-            std::istringstream iss(line);
-            int vid, dummy;
-            int sbegin, send;
-            char ch;
-            iss >> vid;
-            CheckError(vid == line_idx - vertex_begin, "vid mismatches.");
-            iss >> ch;  // '{'
-            iss >> dummy >> dummy >> ch; // Half edges.
-            iss >> sbegin >> send;
-            for (int i = sbegin; i <= send; ++i) {
-                shalf_edge_to_vertex[i] = vid;
-            }
-        } else if (line_idx >= half_edge_begin && line_idx < half_facet_begin) {
-            // Half edges. Do nothing for now.
-        } else if (line_idx >= half_facet_begin && line_idx < volume_begin) {
-            // Half facets. Do the real work here.
-            // Sample line: 10 { 11, 12 83 , , 0 | 0 1 0 -1 } 1
-            std::string new_line = line.substr(0, line.find(',', line.find(',') + 1));
-            std::istringstream iss(new_line);
-            int fid;
-            iss >> fid;
-            CheckError(fid == line_idx - half_facet_begin, "fid mismatches.");
-            char ch;
-            iss >> ch;
-            iss >> half_facet_twins_[fid];
-            new_line = new_line.substr(new_line.find(',') + 1);
-            const std::vector<std::string> words = SplitString(new_line);
-            shalf_edge_in_half_facets[fid].clear();
-            for (const auto& w : words) shalf_edge_in_half_facets[fid].push_back(std::stoi(w));
-        } else if (line_idx >= volume_begin && line_idx < shalf_edge_begin) {
-            // Volumes. Skip.
-        } else if (line_idx >= shalf_edge_begin && line_idx < shalf_edge_begin + shalf_edge_num) {
-            // Shalf edges.
-            // Sample line: 0 { 1, 4, 2, 0, 1, 26, 18, 6 | 0 1 0 0 } 1
-            std::istringstream iss(line);
-            int seid;
-            iss >> seid;
-            CheckError(seid == line_idx - shalf_edge_begin, "seid mismatches.");
-            char ch;
-            iss >> ch;  // '{'
-            int dummy;
-            for (int i = 0; i < 6; ++i) iss >> dummy >> ch;
-            iss >> shalf_edge_next[seid];
-        } else {
-            // We don't care about anything left. Skip.
-        }
-        ++line_idx;
-    }
-    for (const auto& fc : shalf_edge_in_half_facets) {
+    half_facet_twins_.reserve(half_facet_num);
+
+    CGAL::Unique_hash_map<Nef_polyhedron::Vertex_const_handle, int> vertex_index(-1, vertex_num);
+    int vid = 0;
+    for (v_iter = poly_.vertices_begin(); v_iter != poly_.vertices_end(); ++v_iter) vertex_index[v_iter] = vid++;
+    CGAL::Unique_hash_map<Nef_polyhedron::Halffacet_const_handle, int> half_facet_index(-1, half_facet_num);
+    int fid = 0;
+    Nef_polyhedron::Halffacet_const_iterator f_iter;
+    for (f_iter = poly_.halffacets_begin(); f_iter != poly_.halffacets_end(); ++f_iter) half_facet_index[f_iter] = fid++;
+
+    for (f_iter = poly_.halffacets_begin(); f_iter != poly_.halffacets_end(); ++f_iter) {
+        half_facet_twins_.push_back(half_facet_index[f_iter->twin()]);
         std::vector<std::vector<int>> fc_idx;
-        for (const int v : fc) {
+        Nef_polyhedron::Halffacet_cycle_const_iterator fc;
+        for (fc = f_iter->facet_cycles_begin(); fc != f_iter->facet_cycles_end(); ++fc) {
+            // Isolated loops carry no vertices.
+            if (!fc.is_shalfedge()) continue;
+            const Nef_polyhedron::SHalfedge_const_handle se_begin(fc);
+            Nef_polyhedron::SHalfedge_const_handle se = se_begin;
             std::vector<int> vc;
-            vc.push_back(shalf_edge_to_vertex[v]);
-            int v_next = shalf_edge_next[v];
-            while (v_next != v) {
-                vc.push_back(shalf_edge_to_vertex[v_next]);
-                v_next = shalf_edge_next[v_next];
-            }
+            do {
+                vc.push_back(vertex_index[se->source()->center_vertex()]);
+                se = se->next();
+            } while (se != se_begin);
             fc_idx.push_back(vc);
         }
         half_facets_.push_back(fc_idx);
@@ -584,9 +535,11 @@ void Nef3Wrapper::Regularize(const Nef3Wrapper& other, const real eps) {
     const int vertex_num = static_cast<int>(vertices_.size());
     std::vector<int> old_to_new(vertex_num, -1), new_to_old(vertex_num, -1);
     // old_to_new_vertex_mapping must be a permutation.
-    const int target_vertex_num = other.GetVertexNumber();
+    // Candidates are in increasing index order, so the first exact match wins.
     for (int i = 0; i < vertex_num; ++i) {
-        for (int j = 0; j < target_vertex_num; ++j) {
+        const auto candidates = other.vertex_index_.find(HashPoint(vertices_[i]));
+        if (candidates == other.vertex_index_.end()) continue;
+        for (const int j : candidates->second) {
             if (vertices_[i] == other.vertices()[j]) {
                 CheckError(old_to_new[i] == -1 && new_to_old[j] == -1, "Vertices are duplicated.");
                 old_to_new[i] = j;
@@ -616,21 +569,16 @@ void Nef3Wrapper::Regularize(const Nef3Wrapper& other, const real eps) {
     // Update half edges.
     const int edge_num = static_cast<int>(half_edges_.size());
     std::vector<int> old_to_new_edges(edge_num, -1), new_to_old_edges(edge_num, -1);
-    const int target_edge_num = other.GetHalfEdgeNumber();
     for (int i = 0; i < edge_num; ++i) {
-        for (int j = 0; j < target_edge_num; ++j) {
-            const int first_i = old_to_new[half_edges_[i].first];
-            const int second_i = old_to_new[half_edges_[i].second];
-            const int first_other = other.half_edges()[j].first;
-            const int second_other = other.half_edges()[j].second;
-            if (vertices_match_target_[first_i] && vertices_match_target_[second_i] &&
-                first_i == first_other && second_i == second_other) {
-                    old_to_new_edges[i] = j;
-                    new_to_old_edges[j] = i;
-                    half_edges_match_target_[j] = true;
-                    break;
-                }
-        }
+        const int first_i = old_to_new[half_edges_[i].first];
+        const int second_i = old_to_new[half_edges_[i].second];
+        if (!vertices_match_target_[first_i] || !vertices_match_target_[second_i]) continue;
+        const auto match = other.half_edge_index_.find(std::make_pair(first_i, second_i));
+        if (match == other.half_edge_index_.end()) continue;
+        const int j = match->second;
+        old_to_new_edges[i] = j;
+        new_to_old_edges[j] = i;
+        half_edges_match_target_[j] = true;
     }
     unclaimed.clear();
     for (int i = 0; i < edge_num; ++i) {
@@ -651,6 +599,8 @@ void Nef3Wrapper::Regularize(const Nef3Wrapper& other, const real eps) {
     }
     new_half_edges.swap(half_edges_);
     new_half_edge_twins.swap(half_edge_twins_);
+    BuildVertexIndex();
+    BuildHalfEdgeIndex();
 
     // Update half facets.
     for (auto& f : half_facets_)
@@ -660,19 +610,20 @@ void Nef3Wrapper::Regularize(const Nef3Wrapper& other, const real eps) {
     const int facet_num = static_cast<int>(half_facets_.size());
     std::vector<int> old_to_new_facets(facet_num, -1), new_to_old_facets(facet_num, -1);
     const int target_facet_num = other.GetHalfFacetNumber();
+    // Target facets bucketed by FacetKey, in increasing index order; CanPermute confirms each candidate.
+    std::unordered_map<std::vector<int>, std::vector<int>, boost::hash<std::vector<int>>> target_facet_index;
+    for (int j = 0; j < target_facet_num; ++j)
+        target_facet_index[FacetKey(other.half_facets()[j])].push_back(j);
     for (int i = 0; i < facet_num; ++i) {
-        for (int j = 0; j < target_facet_num; ++j) {
-            // Check if half_facets_[i] == other.half_facets()[j].
-            bool all_covered = true;
-            // First, it should have the same number of cycles.
-            // Then, all vertices must match the target.
-            for (const auto& vc : half_facets_[i])
-                for (const int v : vc)
-                    if (!vertices_match_target_[v]) {
-                        all_covered = false;
-                        break;
-                    }
-            if (!all_covered) continue;
+        // All vertices must match the target.
+        bool all_covered = true;
+        for (const auto& vc : half_facets_[i])
+            for (const int v : vc)
+                if (!vertices_match_target_[v]) all_covered = false;
+        if (!all_covered) continue;
+        const auto candidates = target_facet_index.find(FacetKey(half_facets_[i]));
+        if (candidates == target_facet_index.end()) continue;
+        for (const int j : candidates->second) {
             if (CanPermute(half_facets_[i], other.half_facets()[j])) {
                 old_to_new_facets[i] = j;
                 new_to_old_facets[j] = i;
@@ -708,16 +659,36 @@ void Nef3Wrapper::Regularize(const Nef3Wrapper& other, const real eps) {
     new_half_facet_normals.swap(half_facet_normals_);
 }
 
+void Nef3Wrapper::ComputeExactValues() const {
+    for (const auto& v : vertices_) v.exact();
+    for (const auto& n : half_facet_normals_) n.exact();
+}
+
+void Nef3Wrapper::UnsharePolyhedron() {
+    std::stringstream ss;
+    ss << poly_;
+    poly_ = Nef_polyhedron();
+    ss >> poly_;
+}
+
 void Nef3Wrapper::operator+=(const Nef_polyhedron& other) {
-    poly_ = (poly_ + other).regularization();
+    UnionWithoutSync(other);
     SyncDataStructure();
 }
 
 void Nef3Wrapper::operator-=(const Nef_polyhedron& other) {
-    poly_ = (poly_ - other).regularization();
+    DifferenceWithoutSync(other);
     SyncDataStructure();
 }
 
+void Nef3Wrapper::UnionWithoutSync(const Nef_polyhedron& other) {
+    poly_ = (poly_ + other).regularization();
+}
+
+void Nef3Wrapper::DifferenceWithoutSync(const Nef_polyhedron& other) {
+    poly_ = (poly_ - other).regularization();
+}
+
 void Nef3Wrapper::ListVertices() const {
     std::cout << "Vertex number " << vertices_.size() << std::endl;
     int idx = 0;
@@ -771,22 +742,121 @@ void Nef3Wrapper::ListFacets() const {
     }
 }
 
+void Nef3Wrapper::BuildVertexIndex() {
+    vertex_index_.clear();
+    const int vertex_num = static_cast<int>(vertices_.size());
+    for (int i = 0; i < vertex_num; ++i) vertex_index_[HashPoint(vertices_[i])].push_back(i);
+}
+
+void Nef3Wrapper::BuildHalfEdgeIndex() {
+    half_edge_index_.clear();
+    const int edge_num = static_cast<int>(half_edges_.size());
+    // emplace keeps the first half edge with given end points.
+    for (int i = 0; i < edge_num; ++i) half_edge_index_.emplace(half_edges_[i], i);
+}
+
+// Both lookups return the number of vertices (half edges) when nothing matches.
 const int Nef3Wrapper::GetVertexIndex(const Point_3& vertex) const {
-    int idx = 0;
+    const auto candidates = vertex_index_.find(HashPoint(vertex));
+    if (candidates != vertex_index_.end())
+        for (const int i : candidates->second)
+            if (vertices_[i] == vertex) return i;
+    return static_cast<int>(vertices_.size());
+}
+
+const int Nef3Wrapper::GetHalfEdgeIndex(const int source, const int target) const {
+    const auto match = half_edge_index_.find(std::make_pair(source, target));
+    if (match == half_edge_index_.end()) return static_cast<int>(half_edges_.size());
+    return match->second;
+}
+
+const std::vector<real> Nef3Wrapper::GetVertexArray() const {
+    std::vector<real> data;
+    data.reserve(3 * vertices_.size());
     for (const auto& v : vertices_) {
-        if (v.x() == vertex.x() && v.y() == vertex.y() && v.z() == vertex.z()) break;
-        ++idx;
+        data.push_back(CGAL::to_double(v.x().exact()));
+        data.push_back(CGAL::to_double(v.y().exact()));
+        data.push_back(CGAL::to_double(v.z().exact()));
     }
-    return idx;
+    return data;
 }
 
-const int Nef3Wrapper::GetHalfEdgeIndex(const int source, const int target) const {
-    int idx = 0;
+static const bool IsDouble(const Exact_kernel::FT& x) {
+    const auto& exact = x.exact();
+    typedef std::decay<decltype(exact)>::type Exact_number;
+    return exact == Exact_number(CGAL::to_double(exact));
+}
+
+const std::vector<int> Nef3Wrapper::GetVertexExactArray() const {
+    std::vector<int> data;
+    data.reserve(3 * vertices_.size());
+    for (const auto& v : vertices_) {
+        data.push_back(IsDouble(v.x()));
+        data.push_back(IsDouble(v.y()));
+        data.push_back(IsDouble(v.z()));
+    }
+    return data;
+}
+
+const std::vector<std::string> Nef3Wrapper::GetVertexStringArray() const {
+    std::vector<std::string> data;
+    data.reserve(3 * vertices_.size());
+    for (const auto& v : vertices_) {
+        data.push_back(v.x().exact().get_str());
+        data.push_back(v.y().exact().get_str());
+        data.push_back(v.z().exact().get_str());
+    }
+    return data;
+}
+
+const std::vector<int> Nef3Wrapper::GetHalfEdgeArray() const {
+    std::vector<int> data;
+    data.reserve(2 * half_edges_.size());
     for (const auto& e : half_edges_) {
-        if (e.first == source && e.second == target) break;
-        ++idx;
+        data.push_back(e.first);
+        data.push_back(e.second);
     }
-    return idx;
+    return data;
+}
+
+const std::vector<int> Nef3Wrapper::GetHalfFacetOffsetArray() const {
+    std::vector<int> offsets(1, 0);
+    offsets.reserve(half_facets_.size() + 1);
+    for (const auto& f : half_facets_) {
+        offsets.push_back(offsets.back() + static_cast<int>(f.size()));
+    }
+    return offsets;
+}
+
+const std::vector<int> Nef3Wrapper::GetCycleOffsetArray() const {
+    std::vector<int> offsets(1, 0);
+    for (const auto& f : half_facets_)
+        for (const auto& vc : f)
+            offsets.push_back(offsets.back() + static_cast<int>(vc.size()));
+    return offsets;
+}
+
+const std::vector<int> Nef3Wrapper::GetCycleArray() const {
+    std::vector<int> data;
+    for (const auto& f : half_facets_)
+        for (const auto& vc : f)
+            data.insert(data.end(), vc.begin(), vc.end());
+    return data;
+}
+
+const std::vector<real> Nef3Wrapper::GetHalfFacetNormalArray() const {
+    std::vector<real> data;
+    data.reserve(3 * half_facet_normals_.size());
+    for (const auto& n : half_facet_normals_) {
+        data.push_back(CGAL::to_double(n.x()));
+        data.push_back(CGAL::to_double(n.y()));
+        data.push_back(CGAL::to_double(n.z()));
+    }
+    return data;
+}
+
+const std::vector<int> Nef3Wrapper::GetHalfFacetOutwardArray() const {
+    return std::vector<int>(half_facet_outwards_.begin(), half_facet_outwards_.end());
 }
 
 const Vector3r Nef3Wrapper::ToEigenVector3r(const Point_3& point) {
@@ -1,6 +1,7 @@
 #ifndef CORE_NEF3_WRAPPER_H
 #define CORE_NEF3_WRAPPER_H
 
+#include <unordered_map>
 #include "core/config.h"
 #include "CGAL/Exact_predicates_exact_constructions_kernel.h"
 #include "CGAL/Polyhedron_3.h"
@@ -8,6 +9,7 @@
 #include "CGAL/Nef_polyhedron_3.h"
 #include "CGAL/boost/graph/convert_nef_polyhedron_to_polygon_mesh.h"
 #include "CGAL/IO/Nef_polyhedron_iostream_3.h"
+#include "boost/functional/hash.hpp"
 #include "core/common.h"
 #include "core/python_struct.h"
 
@@ -28,6 +30,16 @@ public:
 
     void operator+=(const Nef_polyhedron& other);
     void operator-=(const Nef_polyhedron& other);
+    // Same as += and -= but leave the vertex, edge and facet arrays stale until Sync is called.
+    void UnionWithoutSync(const Nef_polyhedron& other);
+    void DifferenceWithoutSync(const Nef_polyhedron& other);
+    void Sync() { SyncDataStructure(); }
+    // Copies of a Nef polyhedron share one SNC, whose lazy numbers are evaluated by the booleans that use it. This
+    // gives the wrapper a polyhedron of its own, rebuilt from its exact description. The arrays are unchanged.
+    void UnsharePolyhedron();
+    // Compute the exact values of the vertices and normals now instead of on first use. Lazy numbers cache their exact
+    // value when it is first asked for, so values shared between threads must not have any left to compute.
+    void ComputeExactValues() const;
 
     const Nef_polyhedron& poly() const { return poly_; }
     const std::vector<Point_3>& vertices() const { return vertices_; }
@@ -76,12 +88,30 @@ public:
             oss.str()
         };
     }
+    // Bulk versions of the accessors above: each returns the whole topology in one flat array.
+    // Vertices: 3N doubles. Half edges: 2E indices (source, target). Half facets are stored in CSR form:
+    // the cycles of facet f are [facet_offsets[f], facet_offsets[f + 1]) and the vertices of cycle c are
+    // cycle_vertices[cycle_offsets[c]:cycle_offsets[c + 1]].
+    // Vertex coordinates are rounded from their exact values. GetVertexExactArray tells which of the 3N doubles
+    // are exact, so that callers only need the exact strings for the remaining ones.
+    const std::vector<real> GetVertexArray() const;
+    const std::vector<int> GetVertexExactArray() const;
+    const std::vector<std::string> GetVertexStringArray() const;
+    const std::vector<int> GetHalfEdgeArray() const;
+    const std::vector<int> GetHalfFacetOffsetArray() const;
+    const std::vector<int> GetCycleOffsetArray() const;
+    const std::vector<int> GetCycleArray() const;
+    const std::vector<real> GetHalfFacetNormalArray() const;
+    const std::vector<int> GetHalfFacetOutwardArray() const;
 
 private:
     const int GetVertexIndex(const Point_3& vertex) const;
     const int GetHalfEdgeIndex(const int source, const int target) const;
 
     void SyncDataStructure();
+    // Rebuild vertex_index_ and half_edge_index_ after vertices_ or half_edges_ change.
+    void BuildVertexIndex();
+    void BuildHalfEdgeIndex();
     // Given vertices, edges, and facets, compute half_facet_outwards_;
     void ComputeFacetNormal();
     void ComputeFacetOrientation();
@@ -97,6 +127,11 @@ private:
     std::vector<bool> half_facet_outwards_;
     std::vector<Vector_3> half_facet_normals_;
 
+    // Vertices bucketed by the hash of their exact coordinates, each bucket in increasing index order.
+    std::unordered_map<std::size_t, std::vector<int>> vertex_index_;
+    // (source, target) -> first half edge with these end points.
+    std::unordered_map<std::pair<int, int>, int, boost::hash<std::pair<int, int>>> half_edge_index_;
+
     std::vector<bool> vertices_match_target_;
     std::vector<bool> half_edges_match_target_;
     std::vector<bool> half_facets_match_target_;
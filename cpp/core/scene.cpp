@@ -18,30 +18,42 @@ static const real SignedArea(const std::vector<Point_3>& polygon, const Vector_3
     return vol;
 }
 
-Scene::Scene() {}
+Scene::Scene() : target_(std::make_shared<const Nef3Wrapper>()) {}
+
+const Scene Scene::CloneForThread() const {
+    canvas_.ComputeExactValues();
+    target_->ComputeExactValues();
+    Scene scene(*this);
+    scene.canvas_.UnsharePolyhedron();
+    return scene;
+}
 
 void Scene::SetTargetFromOtherScene(const Scene& other) {
+    // No copy needed here: once loaded, a target's polyhedron never goes through a boolean, so sharing it is safe.
     target_ = other.target_;
-    canvas_.Regularize(target_);
+    canvas_.Regularize(*target_);
 }
 
 void Scene::LoadScene(const std::string& file_name) {
     const std::vector<std::string> name_and_ext = SplitString(file_name, '.');
     CheckError(name_and_ext.size() == 2u && name_and_ext[1] == "nef3", "Invalid file name.");
     canvas_.Load(file_name);
-    canvas_.Regularize(target_);
+    canvas_.Regularize(*target_);
 }
 
 void Scene::LoadTarget(const std::string& file_name) {
     const std::vector<std::string> name_and_ext = SplitString(file_name, '.');
     CheckError(name_and_ext.size() == 2u && name_and_ext[1] == "nef3", "Invalid file name.");
-    target_.Load(file_name);
-    canvas_.Regularize(target_);
+    // Never modify a target in place: other scenes may share it.
+    std::shared_ptr<Nef3Wrapper> target = std::make_shared<Nef3Wrapper>();
+    target->Load(file_name);
+    target_ = target;
+    canvas_.Regularize(*target_);
 }
 
 const std::string Scene::GenerateRandomPolygon(const int f_idx, const real skip_prob,
     const real collapse_prob, const bool use_target) const {
-    const Nef3Wrapper& polyhedron = use_target ? target_ : canvas_;
+    const Nef3Wrapper& polyhedron = use_target ? *target_ : canvas_;
     CheckError(0 <= f_idx && f_idx < static_cast<int>(polyhedron.half_facets().size()), "f_idx out of range.");
     CheckError(polyhedron.half_facets()[f_idx].size() == 1u, "Polygon with holes is not supported.");
     const std::vector<int>& vertex_cycle = polyhedron.half_facets()[f_idx][0];
@@ -250,18 +262,97 @@ void Scene::ListSceneFaces() const {
 }
 
 void Scene::ListTargetVertices() const {
-    target_.ListVertices();
+    target_->ListVertices();
 }
 
 void Scene::ListTargetEdges() const {
-    target_.ListEdges();
+    target_->ListEdges();
 }
 
 void Scene::ListTargetFaces() const {
-    target_.ListFacets();
+    target_->ListFacets();
 }
 
 void Scene::ExtrudeFromString(const std::string& str) {
+    char op;
+    const Nef_polyhedron nef_poly = ParseExtrusion(str, op);
+    ApplyExtrusion(nef_poly, op);
+}
+
+void Scene::ExtrudeFromData(const std::vector<real>& polygon, const std::vector<real>& dir, const char op) {
+    const Nef_polyhedron nef_poly = MakeExtrusion(polygon, dir);
+    ApplyExtrusion(nef_poly, op);
+}
+
+const std::vector<int> Scene::ExtrudeFromStrings(const std::vector<std::string>& commands, const bool sync_each) {
+    const int command_num = static_cast<int>(commands.size());
+    std::vector<Nef_polyhedron> nef_polys(command_num);
+    std::string ops(command_num, ' ');
+    std::vector<int> codes(command_num, 0);
+    for (int k = 0; k < command_num; ++k) {
+        try {
+            nef_polys[k] = ParseExtrusion(commands[k], ops[k]);
+            codes[k] = 1;
+        } catch (const std::exception&) {}
+    }
+    ApplyExtrusions(nef_polys, ops, codes, sync_each);
+    return codes;
+}
+
+const std::vector<int> Scene::ExtrudeFromDataArray(const std::vector<real>& polygons, const std::vector<int>& polygon_offsets,
+    const std::vector<real>& dirs, const std::string& ops, const bool sync_each) {
+    const int command_num = static_cast<int>(ops.size());
+    const int polygon_size = static_cast<int>(polygons.size());
+    CheckError(static_cast<int>(polygon_offsets.size()) == command_num + 1, "Expect one more polygon offset than commands.");
+    CheckError(static_cast<int>(dirs.size()) == 3 * command_num, "The directions need three numbers per command.");
+    CheckError(polygon_offsets.back() == polygon_size, "The last polygon offset must end the polygons.");
+    for (int k = 0; k < command_num; ++k) {
+        CheckError(0 <= polygon_offsets[k] && polygon_offsets[k] <= polygon_offsets[k + 1]
+            && polygon_offsets[k + 1] <= polygon_size, "Invalid polygon offsets.");
+    }
+    std::vector<Nef_polyhedron> nef_polys(command_num);
+    std::vector<int> codes(command_num, 0);
+    for (int k = 0; k < command_num; ++k) {
+        try {
+            const std::vector<real> polygon(polygons.begin() + polygon_offsets[k], polygons.begin() + polygon_offsets[k + 1]);
+            const std::vector<real> dir(dirs.begin() + 3 * k, dirs.begin() + 3 * k + 3);
+            nef_polys[k] = MakeExtrusion(polygon, dir);
+            codes[k] = 1;
+        } catch (const std::exception&) {}
+    }
+    ApplyExtrusions(nef_polys, ops, codes, sync_each);
+    return codes;
+}
+
+void Scene::ApplyExtrusions(const std::vector<Nef_polyhedron>& nef_polys, const std::string& ops,
+    std::vector<int>& codes, const bool sync_each) {
+    const Nef3Wrapper before_batch = sync_each ? Nef3Wrapper() : canvas_;
+    bool changed = false;
+    const int command_num = static_cast<int>(codes.size());
+    for (int k = 0; k < command_num; ++k) {
+        if (!codes[k]) continue;
+        // With sync, ApplyExtrusion changes the polyhedron before syncing it, so a failed sync has to be rolled back.
+        // Without, the boolean either succeeds or leaves the canvas alone.
+        const Nef3Wrapper before = sync_each ? canvas_ : Nef3Wrapper();
+        try {
+            ApplyExtrusion(nef_polys[k], ops[k], sync_each);
+            changed = true;
+        } catch (const std::exception&) {
+            if (sync_each) canvas_ = before;
+            codes[k] = 0;
+        }
+    }
+    if (sync_each || !changed) return;
+    try {
+        SyncCanvas();
+    } catch (const std::exception&) {
+        // Some command left a polyhedron that cannot be synced: replay the batch one command at a time to find it.
+        canvas_ = before_batch;
+        ApplyExtrusions(nef_polys, ops, codes, true);
+    }
+}
+
+const Nef_polyhedron Scene::ParseExtrusion(const std::string& str, char& op) const {
     const std::vector<std::string> words = SplitString(str);
     const int word_num = static_cast<int>(words.size());
     std::istringstream iss(str);
@@ -278,31 +369,53 @@ void Scene::ExtrudeFromString(const std::string& str) {
     Nef_polyhedron nef_poly = canvas_.BuildExtrusionFromData(polygon, Aff_transformation_3(CGAL::TRANSLATION, dir));
     CheckError(nef_poly.is_simple(), "The input is not a 2-manifold.");
 
-    // Boolean operation.
     CheckError(words[word_num - 1].size() == 1u, "The last input has to be a char.");
-    const char op = words[word_num - 1][0];
+    op = words[word_num - 1][0];
+    return nef_poly;
+}
+
+const Nef_polyhedron Scene::MakeExtrusion(const std::vector<real>& polygon, const std::vector<real>& dir) const {
+    CheckError(polygon.size() % 3 == 0u, "The polygon needs three numbers per vertex.");
+    CheckError(dir.size() == 3u, "The direction needs three numbers.");
+    const int poly_dof = static_cast<int>(polygon.size() / 3);
+    std::vector<Point_3> points;
+    points.reserve(poly_dof);
+    for (int i = 0; i < poly_dof; ++i) {
+        points.push_back(Point_3(polygon[3 * i], polygon[3 * i + 1], polygon[3 * i + 2]));
+    }
+    const Vector_3 d(dir[0], dir[1], dir[2]);
+    Nef_polyhedron nef_poly = canvas_.BuildExtrusionFromData(points, Aff_transformation_3(CGAL::TRANSLATION, d));
+    CheckError(nef_poly.is_simple(), "The input is not a 2-manifold.");
+    return nef_poly;
+}
+
+void Scene::ApplyExtrusion(const Nef_polyhedron& nef_poly, const char op, const bool sync) {
+    // Boolean operation.
     CheckError(op == '+' || op == '-', "We only support union and difference for now.");
+    if (!sync) {
+        if (op == '+') canvas_.UnionWithoutSync(nef_poly);
+        else canvas_.DifferenceWithoutSync(nef_poly);
+        return;
+    }
     if (op == '+') {
         canvas_ += nef_poly;
     } else {
         canvas_ -= nef_poly;
     }
-    canvas_.Regularize(target_);
+    canvas_.Regularize(*target_);
+}
+
+void Scene::SyncCanvas() {
+    canvas_.Sync();
+    canvas_.Regularize(*target_);
 }
 
 void Scene::ExtrudeFromTargetRef(const int f_idx, const int loop_idx,
     const int v_source, const int v_target, const char op) {
-    Nef_polyhedron nef_poly = target_.BuildExtrusionFromRef(f_idx, loop_idx, v_source, v_target);
+    Nef_polyhedron nef_poly = target_->BuildExtrusionFromRef(f_idx, loop_idx, v_source, v_target);
     CheckError(nef_poly.is_simple(), "The input is not a 2-manifold.");
 
-    // Boolean operation.
-    CheckError(op == '+' || op == '-', "We only support union and difference for now.");
-    if (op == '+') {
-        canvas_ += nef_poly;
-    } else {
-        canvas_ -= nef_poly;
-    }
-    canvas_.Regularize(target_);
+    ApplyExtrusion(nef_poly, op);
 }
 
 void Scene::ExtrudeFromSceneRef(const int f_idx, const int loop_idx,
@@ -310,14 +423,7 @@ void Scene::ExtrudeFromSceneRef(const int f_idx, const int loop_idx,
     Nef_polyhedron nef_poly = canvas_.BuildExtrusionFromRef(f_idx, loop_idx, v_source, v_target);
     CheckError(nef_poly.is_simple(), "The input is not a 2-manifold.");
 
-    // Boolean operation.
-    CheckError(op == '+' || op == '-', "We only support union and difference for now.");
-    if (op == '+') {
-        canvas_ += nef_poly;
-    } else {
-        canvas_ -= nef_poly;
-    }
-    canvas_.Regularize(target_);
+    ApplyExtrusion(nef_poly, op);
 }
 
 void Scene::SaveScene(const std::string& file_name) {
@@ -1,16 +1,26 @@
 #ifndef CORE_SCENE_H
 #define CORE_SCENE_H
 
+#include <memory>
 #include "core/nef3_wrapper.h"
 #include "core/python_struct.h"
 
+// Scene methods that run CGAL release the GIL (see scene.i). A scene made by CloneForThread can be used from another
+// thread while its source and the other clones are in use; a single instance must not be used from two threads.
 class Scene {
 public:
     Scene();
 
+    // The target is immutable and shared between clones, so this only copies the canvas. The copy shares the CGAL
+    // polyhedron of the canvas until one of them changes it, so clones must stay on the thread of their source.
     const Scene Clone() const {
         return Scene(*this);
     }
+    // Same as Clone, but the clone can be handed to another thread: it gets a polyhedron of its own, rebuilt from the
+    // exact description of the canvas, and the lazy numbers it still shares with this scene (the vertices and normals
+    // of the canvas and of the target) are evaluated now, so that other threads only read them. Slower than Clone,
+    // and must not run while another thread uses this scene.
+    const Scene CloneForThread() const;
     void SetTargetFromOtherScene(const Scene& other);
 
     void LoadScene(const std::string& file_name);
@@ -22,6 +32,19 @@ public:
     void ListTargetEdges() const;
     void ListTargetFaces() const;
     void ExtrudeFromString(const std::string& str);
+    // Same as ExtrudeFromString but takes the polygon (3N values) and the direction (3 values) as doubles,
+    // which are converted to exact numbers without going through strings.
+    void ExtrudeFromData(const std::vector<real>& polygon, const std::vector<real>& dir, const char op);
+    // Batched versions of the two above: apply a sequence of extrusions in one call. A command that fails is skipped,
+    // and the next one applies to the canvas as it was. Returns one code per command: 1 if it was applied, 0 if it
+    // failed. Unless sync_each is set, the canvas is synced and regularized once at the end instead of after every
+    // command, so a command only fails early if its extrusion or its boolean does; if that final sync fails, the
+    // batch is replayed from the start with sync_each set, so the codes always say exactly what was applied.
+    const std::vector<int> ExtrudeFromStrings(const std::vector<std::string>& commands, const bool sync_each);
+    // The polygons are stored back to back: polygon k is polygons[polygon_offsets[k]:polygon_offsets[k + 1]].
+    // dirs holds three values per command and ops one char per command.
+    const std::vector<int> ExtrudeFromDataArray(const std::vector<real>& polygons, const std::vector<int>& polygon_offsets,
+        const std::vector<real>& dirs, const std::string& ops, const bool sync_each);
     void ExtrudeFromSceneRef(const int f_idx, const int loop_idx,
         const int v_source, const int v_target, const char op);
     void ExtrudeFromTargetRef(const int f_idx, const int loop_idx,
@@ -32,22 +55,46 @@ public:
 
     // For Python binding.
     const int GetSceneVertexNumber() const { return canvas_.GetVertexNumber(); }
-    const int GetTargetVertexNumber() const { return target_.GetVertexNumber(); }
+    const int GetTargetVertexNumber() const { return target_->GetVertexNumber(); }
     const VertexInfo GetSceneVertex(const int vid) const { return canvas_.GetVertexInfo(vid); }
-    const VertexInfo GetTargetVertex(const int vid) const { return target_.GetVertexInfo(vid); }
+    const VertexInfo GetTargetVertex(const int vid) const { return target_->GetVertexInfo(vid); }
 
     const int GetSceneHalfEdgeNumber() const { return canvas_.GetHalfEdgeNumber(); }
-    const int GetTargetHalfEdgeNumber() const { return target_.GetHalfEdgeNumber(); }
+    const int GetTargetHalfEdgeNumber() const { return target_->GetHalfEdgeNumber(); }
     const HalfEdgeInfo GetSceneHalfEdge(const int eid) const { return canvas_.GetHalfEdgeInfo(eid); }
-    const HalfEdgeInfo GetTargetHalfEdge(const int eid) const { return target_.GetHalfEdgeInfo(eid); }
+    const HalfEdgeInfo GetTargetHalfEdge(const int eid) const { return target_->GetHalfEdgeInfo(eid); }
 
     const int GetSceneHalfFacetNumber() const { return canvas_.GetHalfFacetNumber(); }
-    const int GetTargetHalfFacetNumber() const { return target_.GetHalfFacetNumber(); }
+    const int GetTargetHalfFacetNumber() const { return target_->GetHalfFacetNumber(); }
     const HalfFacetInfo GetSceneHalfFacet(const int eid) const { return canvas_.GetHalfFacetInfo(eid); }
-    const HalfFacetInfo GetTargetHalfFacet(const int eid) const { return target_.GetHalfFacetInfo(eid); }
+    const HalfFacetInfo GetTargetHalfFacet(const int eid) const { return target_->GetHalfFacetInfo(eid); }
+
+    // Bulk topology export: one call returns the whole canvas (or target) instead of one call per element.
+    const std::vector<real> GetVertexArray(const bool use_target) const { return SelectPolyhedron(use_target).GetVertexArray(); }
+    const std::vector<int> GetVertexExactArray(const bool use_target) const { return SelectPolyhedron(use_target).GetVertexExactArray(); }
+    const std::vector<std::string> GetVertexStringArray(const bool use_target) const { return SelectPolyhedron(use_target).GetVertexStringArray(); }
+    const std::vector<int> GetHalfEdgeArray(const bool use_target) const { return SelectPolyhedron(use_target).GetHalfEdgeArray(); }
+    const std::vector<int> GetHalfEdgeTwinArray(const bool use_target) const { return SelectPolyhedron(use_target).half_edge_twins(); }
+    const std::vector<int> GetHalfFacetOffsetArray(const bool use_target) const { return SelectPolyhedron(use_target).GetHalfFacetOffsetArray(); }
+    const std::vector<int> GetCycleOffsetArray(const bool use_target) const { return SelectPolyhedron(use_target).GetCycleOffsetArray(); }
+    const std::vector<int> GetCycleArray(const bool use_target) const { return SelectPolyhedron(use_target).GetCycleArray(); }
+    const std::vector<int> GetHalfFacetTwinArray(const bool use_target) const { return SelectPolyhedron(use_target).half_facet_twins(); }
+    const std::vector<real> GetHalfFacetNormalArray(const bool use_target) const { return SelectPolyhedron(use_target).GetHalfFacetNormalArray(); }
+    const std::vector<int> GetHalfFacetOutwardArray(const bool use_target) const { return SelectPolyhedron(use_target).GetHalfFacetOutwardArray(); }
 
 private:
-    Nef3Wrapper target_;
+    const Nef_polyhedron ParseExtrusion(const std::string& str, char& op) const;
+    const Nef_polyhedron MakeExtrusion(const std::vector<real>& polygon, const std::vector<real>& dir) const;
+    // Merge or subtract an extrusion and regularize the result. Without sync, the canvas stays stale until SyncCanvas.
+    void ApplyExtrusion(const Nef_polyhedron& nef_poly, const char op, const bool sync = true);
+    void SyncCanvas();
+    // The second half of the batched extrusions. codes holds 1 for each extrusion that was built and 0 for the others,
+    // which are skipped; an extrusion that cannot be applied gets 0 too.
+    void ApplyExtrusions(const std::vector<Nef_polyhedron>& nef_polys, const std::string& ops,
+        std::vector<int>& codes, const bool sync_each);
+    const Nef3Wrapper& SelectPolyhedron(const bool use_target) const { return use_target ? *target_ : canvas_; }
+
+    std::shared_ptr<const Nef3Wrapper> target_;
     Nef3Wrapper canvas_;
 };
 
@@ -17,9 +17,49 @@
     }
 }
 
+// The methods below spend their time in exact CGAL booleans and file IO, so they release the GIL while they run.
+// Errors are recorded inside the GIL-free section and raised once the GIL is held again.
+%define RELEASE_GIL(method)
+%exception method {
+    bool gil_failed = false;
+    std::string gil_error;
+    Py_BEGIN_ALLOW_THREADS
+    try {
+        $action
+    } catch (const std::runtime_error& e) {
+        gil_failed = true;
+        gil_error = e.what();
+    } catch (...) {
+        gil_failed = true;
+        gil_error = "Unknown error.";
+    }
+    Py_END_ALLOW_THREADS
+    if (gil_failed) {
+        PyErr_SetString(PyExc_RuntimeError, gil_error.c_str());
+        SWIG_fail;
+    }
+}
+%enddef
+
+RELEASE_GIL(Scene::CloneForThread);
+RELEASE_GIL(Scene::SetTargetFromOtherScene);
+RELEASE_GIL(Scene::LoadScene);
+RELEASE_GIL(Scene::LoadTarget);
+RELEASE_GIL(Scene::ExtrudeFromString);
+RELEASE_GIL(Scene::ExtrudeFromData);
+RELEASE_GIL(Scene::ExtrudeFromStrings);
+RELEASE_GIL(Scene::ExtrudeFromDataArray);
+RELEASE_GIL(Scene::ExtrudeFromSceneRef);
+RELEASE_GIL(Scene::ExtrudeFromTargetRef);
+RELEASE_GIL(Scene::GenerateRandomPolygon);
+RELEASE_GIL(Scene::SaveScene);
+RELEASE_GIL(Scene::Convert);
+
 namespace std {
     %template(VecInt) vector<int>;
     %template(VecVecInt) vector<vector<int>>;
+    %template(VecReal) vector<double>;
+    %template(VecString) vector<string>;
 };
 
 %include "config.h"
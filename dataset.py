@@ -0,0 +1,101 @@
+"""Trajectories generated once, stored as featurized arrays, and loaded back with memory mapping.
+Training from a dataset never runs CGAL, and never imports the scene extension.
+
+python dataset.py data/extrude2 -n 2 --trajectories 10000 --workers 8
+python agent.py --dataset data/extrude2 -b gnn
+
+A dataset directory holds one .npy file per array. Arrays over states are concatenated and indexed by offsets:
+X: featurized states, rows of state s are X[stateOffsets[s]:stateOffsets[s + 1]]
+incidence, codes: relationships of state s are incidence[incidenceOffsets[s]:incidenceOffsets[s + 1]]
+actions: for each state, (index of the feature acted upon, action index)
+trajectoryOffsets: states of trajectory t are stateOffsets[t]..stateOffsets[t + 1]
+"""
+import os
+import random
+
+import numpy as np
+
+from torch.utils.data import Dataset
+
+from agent import Featurization
+
+ARRAYS = ["X", "stateOffsets", "incidence", "codes", "incidenceOffsets", "actions", "trajectoryOffsets"]
+
+def buildDataset(directory, trajectories, N=2, workers=0):
+    from agent import makeExample
+
+    if workers > 0:
+        from producer import ExampleProducer
+        producer = ExampleProducer(N=N, workers=workers)
+        examples = iter(producer)
+    else:
+        producer = None
+        examples = (makeExample(N=N)[:2] for _ in range(trajectories))
+
+    X, incidence, codes, actions = [], [], [], []
+    stateOffsets, incidenceOffsets, trajectoryOffsets = [0], [0], [0]
+    try:
+        for _ in range(trajectories):
+            states, trajectory = next(examples)
+            for s,a in zip(states, trajectory):
+                featurization = Featurization.ofState(s)
+                action_index, feature = a.code()
+                feature_index = featurization.index[s.findClose(feature)]
+
+                X.append(featurization.X)
+                incidence.append(featurization.incidence)
+                codes.append(featurization.codes)
+                actions.append((feature_index, action_index))
+                stateOffsets.append(stateOffsets[-1] + len(featurization))
+                incidenceOffsets.append(incidenceOffsets[-1] + len(featurization.codes))
+            trajectoryOffsets.append(len(actions))
+    finally:
+        if producer is not None: producer.close()
+
+    arrays = {"X": np.concatenate(X).astype(np.float32),
+              "stateOffsets": np.array(stateOffsets, dtype=np.int64),
+              "incidence": np.concatenate(incidence).astype(np.int32),
+              "codes": np.concatenate(codes).astype(np.int8),
+              "incidenceOffsets": np.array(incidenceOffsets, dtype=np.int64),
+              "actions": np.array(actions, dtype=np.int32).reshape(-1, 2),
+              "trajectoryOffsets": np.array(trajectoryOffsets, dtype=np.int64)}
+    os.makedirs(directory, exist_ok=True)
+    for name, array in arrays.items():
+        np.save(os.path.join(directory, name + ".npy"), array)
+
+class TrajectoryDataset(Dataset):
+    """Map-style dataset over the trajectories of a dataset directory.
+    Each item is a list of (Featurization, feature index, action index), one for each step of the trajectory."""
+    def __init__(self, directory):
+        super(TrajectoryDataset, self).__init__()
+        for name in ARRAYS:
+            setattr(self, name, np.load(os.path.join(directory, name + ".npy"), mmap_mode='r'))
+
+    def __len__(self):
+        return len(self.trajectoryOffsets) - 1
+
+    def state(self, s):
+        X = np.asarray(self.X[self.stateOffsets[s]:self.stateOffsets[s + 1]])
+        incidence = np.asarray(self.incidence[self.incidenceOffsets[s]:self.incidenceOffsets[s + 1]], dtype=np.int64)
+        codes = np.asarray(self.codes[self.incidenceOffsets[s]:self.incidenceOffsets[s + 1]], dtype=np.int64)
+        feature_index, action_index = self.actions[s].tolist()
+        return Featurization(None, X, incidence, codes), feature_index, action_index
+
+    def __getitem__(self, t):
+        return [self.state(s)
+                for s in range(self.trajectoryOffsets[t], self.trajectoryOffsets[t + 1]) ]
+
+    def sample(self):
+        return self[random.randrange(len(self))]
+
+if __name__ == "__main__":
+    import argparse
+    parser = argparse.ArgumentParser(description = "build a trajectory dataset")
+    parser.add_argument("directory")
+    parser.add_argument("--numberExtrusions","-n",default=2,type=int)
+    parser.add_argument("--trajectories",default=1000,type=int)
+    parser.add_argument("--workers","-w",default=0,type=int)
+    arguments = parser.parse_args()
+
+    buildDataset(arguments.directory, arguments.trajectories,
+                 N=arguments.numberExtrusions, workers=arguments.workers)
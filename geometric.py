@@ -4,6 +4,7 @@ import numpy as np
 
 import torch
 import torch.nn as nn
+import torch.nn.functional as F
 
 # from torch_geometric.nn import MessagePassing
 # from torch_geometric.utils import add_self_loops, degree
@@ -28,18 +29,54 @@ class GraphLayer(Module):
 
         self.finalize()
 
-    def forward(self, e, c):
-        """e: embedding of CAD features, NxH
-        c: one-hot characterization of edge, NxNxC"""
-        N = e.size(0)
-        x = e.unsqueeze(1).expand(-1,N,-1)
-        y = e.unsqueeze(0).expand(N,-1,-1)
-        z = torch.cat([x,y,c],2)
-        z = self.message(z).sum(1)
-        prediction = self.update(torch.cat([z,e],1))
+    def forward(self, e, c, mask=None):
+        """e: embedding of CAD features, NxH, or BxNxH for a padded batch
+        c: one-hot characterization of edge, NxNxC, or BxNxNxC
+        mask: for batches, BxN with 1 for features and 0 for padding, which sends no messages"""
+        if e.dim() == 2:
+            return self(e.unsqueeze(0), c.unsqueeze(0)).squeeze(0)
+        B, N = e.size(0), e.size(1)
+        x = e.unsqueeze(2).expand(-1,-1,N,-1)
+        y = e.unsqueeze(1).expand(-1,N,-1,-1)
+        z = torch.cat([x,y,c],3)
+        z = self.message(z)
+        if mask is not None:
+            z = z*mask.view(B,1,N,1)
+        z = z.sum(2)
+        prediction = self.update(torch.cat([z,e],2))
 
         return prediction
 
+    def sparseForward(self, e, incidence, codes, graph):
+        """Message passing over an incidence list, in time and memory linear in the number of features and incidences.
+        e: MxH embedding of the features of one or more graphs; graph: M, which graph each feature belongs to
+        incidence: Px2 (receiver, sender) long tensor; codes: P indices into edgeCode
+        Incidences and self loops send their messages exactly, as in forward.
+        The n other senders of a feature, which are disconnected from it, are summarized by their mean:
+        they send n times the message that their mean would send.
+        This is an approximation, not forward computed sparsely: the message network is not linear, so the two only
+        agree when every feature has at most one disconnected sender. A model trained with one of them should not be
+        evaluated with the other."""
+        M = e.size(0)
+        disconnected = torch.full((M,), BoundaryEncoder.edgeCode.index("disconnected"),
+                                  dtype=torch.long, device=e.device)
+        receiver, sender = incidence[:,0], incidence[:,1]
+
+        z = torch.zeros_like(e).index_add(0, receiver,
+                                          self.message(torch.cat([e[receiver], e[sender], F.one_hot(codes, self.C).float()],1)))
+        z = z + self.message(torch.cat([e, e, F.one_hot(disconnected, self.C).float()],1))
+
+        ones = torch.ones(M, device=e.device)
+        size = torch.zeros(int(graph.max()) + 1, device=e.device).index_add(0, graph, ones)[graph]
+        total = torch.zeros(int(graph.max()) + 1, e.size(1), device=e.device).index_add(0, graph, e)[graph]
+        degree = torch.zeros(M, device=e.device).index_add(0, receiver, torch.ones(receiver.size(0), device=e.device))
+        neighbors = torch.zeros_like(e).index_add(0, receiver, e[sender])
+        n = (size - degree - 1).unsqueeze(1)
+        mean = (total - neighbors - e)/n.clamp(min=1)
+        z = z + n*self.message(torch.cat([e, mean, F.one_hot(disconnected, self.C).float()],1))
+
+        return self.update(torch.cat([z,e],1))
+
 class BoundaryEncoder(Module):
     edgeCode = ["e2v","e2f","f2e","v2e","v2f","f2v","disconnected"]
     def __init__(self, layers, H=128):
@@ -47,18 +84,45 @@ class BoundaryEncoder(Module):
         self.layers = nn.ModuleList([GraphLayer(H) for _ in range(layers) ])
         self.finalize()
 
-    def forward(self, e, c):
-        """c: should be a matrix-like thing whose entries are strings inside of edgeCode"""
-        N = e.size(0)
-        a = np.zeros((N,N,len(BoundaryEncoder.edgeCode)))
-        for i in range(N):
-            for j in range(N):
-                theCode = BoundaryEncoder.edgeCode.index(c[i][j])
-                a[i,j,theCode] = 1
-        a = self.tensor(a)
+    def forward(self, e, c, mask=None):
+        """e: NxH, or BxNxH for a padded batch, in which case mask is BxN with 0 for padding
+        c: NxN (or BxNxN) integer tensor or array of indices into edgeCode,
+           or for a single graph the sparse pair (incidence, codes) of Featurization"""
+        if isinstance(c, tuple):
+            c = BoundaryEncoder.codeMatrix(e.size(0), *c, device=e.device)
+        c = self.device(torch.as_tensor(c, dtype=torch.long))
+        a = F.one_hot(c, len(BoundaryEncoder.edgeCode)).float()
+
+        for l in self.layers:
+            e = l(e,a,mask)
+        return e
 
+    @staticmethod
+    def codeMatrix(N, incidence, codes, batch=None, B=None, device=None):
+        """Dense relationship codes from an incidence list, built directly on the device.
+        returns NxN, or BxNxN when each incidence also comes with the index of its batch entry"""
+        incidence = torch.as_tensor(incidence, dtype=torch.long, device=device).view(-1, 2)
+        codes = torch.as_tensor(codes, dtype=torch.long, device=device)
+        shape = (N, N) if batch is None else (B, N, N)
+        c = torch.full(shape, BoundaryEncoder.edgeCode.index("disconnected"), dtype=torch.long, device=device)
+        index = (incidence[:,0], incidence[:,1])
+        if batch is not None:
+            index = (torch.as_tensor(batch, dtype=torch.long, device=device),) + index
+        c[index] = codes
+        return c
+
+    def sparseForward(self, e, incidence, codes, graph=None):
+        """e: MxH; incidence: Px2 pairs (i, j) of incident features; codes: P indices into edgeCode
+        graph: which graph each feature belongs to, when e holds several of them
+        See GraphLayer.sparseForward: costs O(M + P) instead of O(M^2), but approximates the messages of
+        disconnected features, so it is not interchangeable with forward"""
+        incidence = self.device(torch.as_tensor(incidence, dtype=torch.long).view(-1, 2))
+        codes = self.device(torch.as_tensor(codes, dtype=torch.long))
+        if graph is None:
+            graph = torch.zeros(e.size(0), dtype=torch.long)
+        graph = self.device(torch.as_tensor(graph, dtype=torch.long))
         for l in self.layers:
-            e = l(e,a)
+            e = l.sparseForward(e, incidence, codes, graph)
         return e
         
 
@@ -0,0 +1,91 @@
+import multiprocessing
+import queue
+import random
+
+import numpy as np
+
+import torch
+from torch.utils.data import IterableDataset
+
+
+def _produce(seed, N, referenceProgram, examples, stop):
+    """worker loop: keeps making (states, actions) trajectories until told to stop"""
+    from agent import makeExample
+
+    random.seed(seed)
+    np.random.seed(seed%(2**32))
+    torch.manual_seed(seed)
+    # trajectories left unsent when we stop are dropped, instead of keeping this process alive
+    examples.cancel_join_thread()
+    try:
+        while not stop.is_set():
+            states, actions, _, _ = makeExample(referenceProgram, N)
+            # the queue is bounded, so wait for the trainer to make room, but keep listening for stop
+            while not stop.is_set():
+                try:
+                    examples.put((states, actions), timeout=0.1)
+                    break
+                except queue.Full: continue
+    except KeyboardInterrupt: pass
+
+
+class ExampleProducer(IterableDataset):
+    """Endless stream of (states, actions) training trajectories, generated by a pool of worker processes.
+    At most `prefetch` trajectories wait in the queue, so the workers stay ahead of training without running away from it.
+    The states are detached (see State.__getstate__): they can be featurized and trained on, but not stepped.
+    The pool parallelizes by itself, so give it to a DataLoader with num_workers=0 and batch_size=None.
+
+    with ExampleProducer(N=2, workers=8) as producer:
+        for states, actions in producer: ...
+    """
+    def __init__(self, N=2, workers=None, prefetch=16, seed=None, referenceProgram=None):
+        super(ExampleProducer, self).__init__()
+        self.N, self.referenceProgram = N, referenceProgram
+        self.workers = workers or multiprocessing.cpu_count()
+        self.prefetch = prefetch
+        self.seed = random.randrange(2**31) if seed is None else seed
+
+        self.context = multiprocessing.get_context("spawn")
+        self.examples = None
+        self.stop = None
+        self.processes = []
+
+    def start(self):
+        if self.processes: return
+        self.examples = self.context.Queue(self.prefetch)
+        self.stop = self.context.Event()
+        self.processes = [self.context.Process(target=_produce,
+                                               args=(self.seed + n, self.N, self.referenceProgram,
+                                                     self.examples, self.stop),
+                                               daemon=True)
+                          for n in range(self.workers) ]
+        for p in self.processes: p.start()
+
+    def __iter__(self):
+        self.start()
+        while True:
+            yield self.examples.get()
+
+    def close(self, timeout=5):
+        if not self.processes: return
+        self.stop.set()
+        # workers blocked on a full queue notice the stop once there is room or their put times out
+        try:
+            while True: self.examples.get_nowait()
+        except queue.Empty: pass
+        for p in self.processes:
+            p.join(timeout)
+            if p.is_alive(): p.terminate()
+        self.examples.close()
+        self.examples.join_thread()
+        self.processes = []
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, *_):
+        self.close()
+
+    def __del__(self):
+        self.close()
@@ -1,5 +1,7 @@
 from CAD import *
 
+import weakref
+
 class Death(Exception): pass
 
 ALL_TAGS = [
@@ -8,34 +10,133 @@ ALL_TAGS = [
     "EXTRUDE_START"
     ]
 
+class TagMap():
+    """Persistent map from features to their sets of tags.
+    Untagged features are not stored, and updating returns a new map which leaves this one alone,
+    so the cost of an update is proportional to the number of tagged features rather than all features."""
+    def __init__(self, tags=None):
+        self._tags = {f: frozenset(ts)
+                      for f,ts in (tags or {}).items()
+                      if ts }
+
+    def __getitem__(self, feature):
+        return self._tags.get(feature, frozenset())
+
+    def items(self):
+        return self._tags.items()
+
+    def update(self, feature, tags):
+        m = TagMap()
+        m._tags = dict(self._tags)
+        if tags: m._tags[feature] = frozenset(tags)
+        else: m._tags.pop(feature, None)
+        return m
+
+class Registry():
+    """The vertices, edges and faces of one or more b-reps, with vertices that are close to each other merged.
+    A registry can extend a parent registry, which it shares without modifying it:
+    this is how every State of a trajectory reuses the registered features of its target."""
+    _targets = weakref.WeakKeyDictionary()
+
+    def __init__(self, parent=None):
+        self.parent = parent
+        self.vertexIndex = VertexIndex(parent=parent.vertexIndex if parent else None)
+        # only what the parent does not already have: lookups chain to the parent instead of copying it
+        self.ownVertices, self.ownEdges, self.ownFaces = [], [], []
+        self._edges, self._faces = set(), set()
+        # features registered directly into this registry, as opposed to the parent
+        self.features = set()
+
+    @property
+    def vertices(self):
+        return (self.parent.vertices if self.parent else []) + self.ownVertices
+
+    @property
+    def edges(self):
+        return (self.parent.edges if self.parent else []) + self.ownEdges
+
+    @property
+    def faces(self):
+        return (self.parent.faces if self.parent else []) + self.ownFaces
+
+    def hasEdge(self, e):
+        return e in self._edges or (self.parent is not None and self.parent.hasEdge(e))
+
+    def hasFace(self, f):
+        return f in self._faces or (self.parent is not None and self.parent.hasFace(f))
+
+    @staticmethod
+    def ofTarget(target):
+        """registry of a target b-rep, built once and then shared by every State that refers to it"""
+        r = Registry._targets.get(target)
+        if r is None:
+            r = Registry()
+            for v in target.getVertices(): r.registerVertex(v)
+            for e in target.getEdges(): r.registerEdge(e)
+            for f in target.getFaces(): r.registerFace(f)
+            r.features = frozenset(r.features)
+            Registry._targets[target] = r
+        return r
+
+    def findClose(self, v):
+        return self.vertexIndex.findClose(v)
+
+    def registerVertex(self, v):
+        vp = self.findClose(v)
+        if vp is not None: v = vp
+        else:
+            self.ownVertices.append(v)
+            self.vertexIndex.add(v)
+        self.features.add(v)
+        return v
+
+    def registerEdge(self, e):
+        e = Edge(self.findClose(e.e[0]),self.findClose(e.e[1]))
+        self.features.add(e)
+        if not self.hasEdge(e):
+            self._edges.add(e)
+            self.ownEdges.append(e)
+        return e
+
+    def registerFace(self, f):
+        f = Face([ frozenset(self.registerVertex(v) for v in cycle)
+                   for cycle in f.cycles ])
+        self.features.add(f)
+        if not self.hasFace(f):
+            self._faces.add(f)
+            self.ownFaces.append(f)
+        return f
+
 class State():
     def __init__(self, canvas, target, tags=None, extrude_vertices=[]):
         self.canvas, self.target = canvas, target
 
-        self.canvas_features = set()
-        self.target_features = set()
-        self.vertices = []
-
-        for v in target.getVertices():
-            self.registerVertex(v,True,False)
+        # target features are registered once per target; only the canvas is registered here
+        targetRegistry = Registry.ofTarget(target)
+        self.registry = Registry(targetRegistry)
         for v in canvas.getVertices():
-            self.registerVertex(v,False,True)
-
-        self.edges = []
-        for e in target.getEdges():
-            self.registerEdge(e,True,False)
+            self.registry.registerVertex(v)
         for e in canvas.getEdges():
-            self.registerEdge(e,False,True)
-
-        self.faces = []
-        for f in target.getFaces():
-            self.registerFace(f,True,False)
+            self.registry.registerEdge(e)
         for f in canvas.getFaces():
-            self.registerFace(f,False,True)
+            self.registry.registerFace(f)
 
-        self.tags = tags or {feature: set()
-                             for feature in self.canvas_features|self.target_features}
+        self.target_features = targetRegistry.features
+        self.canvas_features = self.registry.features
+
+        self.tags = tags if isinstance(tags, TagMap) else TagMap(tags)
         self.extrude_vertices = extrude_vertices
+        # cache for Agent.featurize
+        self.featurization = None
+
+    @property
+    def vertices(self): return self.registry.vertices
+
+    @property
+    def edges(self): return self.registry.edges
+
+    @property
+    def faces(self): return self.registry.faces
 
     def visualize(self,fn,title=None):
         # Modify your camera parameters here to generate +x, -x, +y, -y, +z, and -z images as you wish.
@@ -132,12 +233,7 @@ class State():
                 print(v)
             assert 0
         feature = feature_
-        tags = {k: (v if k != feature else v|{tag})
-            for k,v in self.tags.items() }
-        return State(self.canvas,
-                     self.target,
-                     tags,
-                     self.extrude_vertices)
+        return self.withTags(self.tags.update(feature, self.tags[feature]|{tag}))
 
     def showTags(self):
         for k,v in self.tags.items():
@@ -148,37 +244,37 @@ class State():
         feature_ = self.findClose(feature)
         if feature_ is None: assert 0
         feature = feature_
-        tags = {k: (v if k != feature else v-{tag})
-            for k,v in self.tags.items() }
-        return State(self.canvas,
-                     self.target,
-                     tags,
-                     self.extrude_vertices)
+        return self.withTags(self.tags.update(feature, self.tags[feature]-{tag}))
+
+    def withTags(self, tags):
+        """same geometry, different tags. Shares everything else with this state instead of re-querying the scenes"""
+        s = State.__new__(State)
+        s.__dict__.update(self.__dict__)
+        s.tags = tags
+        # the featurization includes the tags
+        s.featurization = None
+        return s
+
+    def __getstate__(self):
+        """Scenes cannot be pickled, so pickled states are detached from their canvas and target.
+        A detached state still has its features and tags, which is all that featurizing and training need."""
+        d = dict(self.__dict__)
+        d["canvas"] = None
+        d["target"] = None
+        return d
 
     def getTagged(self, tag):
         return [f for f,ts in self.tags.items() if tag in ts]
             
 
-    def registerVertex(self,v, spec, canvas):
-        vp = self.findClose(v)
-        if vp is not None: v = vp
-        
-        if spec: self.target_features.add(v)
-        if canvas: self.canvas_features.add(v)
-        if vp is None:
-            self.vertices.append(v)
-        return v
-
     def findClose(self,v):
         if isinstance(v,Vertex):
-            candidates = [vp for vp in self.vertices if v.close(vp) ]
-            if candidates: return candidates[0]
-            return None
+            return self.registry.findClose(v)
         elif isinstance(v,Edge):
             u,v = self.findClose(v.e[0]),self.findClose(v.e[1])
             if u is None or v is None: return None            
             v = Edge(u,v)
-            if v not in self.tags: return None
+            if v not in self.canvas_features and v not in self.target_features: return None
             return v
         elif isinstance(v,Face):
             cycles = []
@@ -187,27 +283,11 @@ class State():
                 if any( e is None for e in cycle ): return None
                 cycles.append(cycle)
             f = Face(cycles)
-            if f not in self.tags: return None
+            if f not in self.canvas_features and f not in self.target_features: return None
             return f
         else:
             assert False, "attempt to find something close which was not a feature"
 
-    def registerEdge(self,e, spec, canvas):
-        e = Edge(self.findClose(e.e[0]),self.findClose(e.e[1]))
-        if spec: self.target_features.add(e)
-        if canvas: self.canvas_features.add(e)
-        if e not in self.edges:
-            self.edges.append(e)
-        return e
-
-    def registerFace(self,f, spec, canvas):
-        f = Face([ frozenset(self.registerVertex(v, spec, canvas) for v in cycle)
-                   for cycle in f.cycles ])
-        if spec: self.target_features.add(f)
-        if canvas: self.canvas_features.add(f)
-        if f not in self.faces:
-            self.faces.append(f)
-
 class Action():
     def __repr__(self):
         return str(self)
@@ -260,9 +340,7 @@ class Extrude(Action):
                         self.v.p[1] - el.p[1],
                         self.v.p[2] - el.p[2])
 
-        face = [(v.x,v.y,v.z)
-                for v in s.extrude_vertices]
-        newCanvas = s.canvas.extrude(face, displacement, self.union)
+        newCanvas = s.canvas.extrude(s.extrude_vertices, displacement, self.union)
 
         return State(newCanvas, s.target)
 
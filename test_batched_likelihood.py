@@ -0,0 +1,34 @@
+import random
+
+import torch
+
+from common import print_info, print_error, print_ok
+from transformer import Transformer, Pointer
+
+############## Sample code begins ################
+random.seed(0)
+torch.manual_seed(0)
+digits = [str(n) for n in range(9) ]
+# the teacher-forced pass equals decoding each prefix on its own only with a single decoder block
+m = Transformer(digits, layers=1, heads=4, embedding_size=32, positional_input=True)
+m.eval()
+
+print_info('Comparing batched_logLikelihood with the sum of logLikelihood over the examples...')
+largest = 0.
+with torch.no_grad():
+    for _ in range(10):
+        xs, ys = [], []
+        # inputs and outputs of different lengths, so that padding is exercised
+        for _ in range(random.randint(1,8)):
+            x = [random.choice(digits) for _ in range(random.randint(2,5)) ]
+            y = [Pointer(random.randrange(len(x))) if random.random() < 0.3 else random.choice(digits)
+                 for _ in range(random.randint(0,6)) ]
+            xs.append(x)
+            ys.append(y)
+        batched = m.batched_logLikelihood(xs, ys).item()
+        expected = sum(m.logLikelihood(x, y).item() for x,y in zip(xs, ys))
+        largest = max(largest, abs(batched - expected)/max(1., abs(expected)))
+if largest < 1e-4:
+    print_ok('Largest relative difference:', largest)
+else:
+    print_error('Largest relative difference:', largest)
@@ -0,0 +1,63 @@
+import numpy as np
+
+from common import print_info, print_error, print_ok
+from CAD import *
+from state import State, ALL_TAGS
+from geometric import BoundaryEncoder
+from agent import Featurization
+
+# The double loop that Featurization.ofState used to run, kept here as the reference for the vectorized version.
+def reference(state):
+    def vectorize(f):
+        if isinstance(f,Vertex):
+            return [1,0,0,int(f in state.canvas_features),int(f in state.target_features)] + \
+                list(f.p)
+        if isinstance(f,Edge):
+            return [0,1,0,int(f in state.canvas_features),int(f in state.target_features)]
+        if isinstance(f,Face):
+            return [0,0,1,int(f in state.canvas_features),int(f in state.target_features)]
+
+    fs = sorted(state.canvas_features|state.target_features)
+    X = np.zeros((len(fs), Featurization.width), dtype=np.float32)
+    incidence = []
+    codes = []
+    for i,f in enumerate(fs):
+        v = vectorize(f)
+        v.extend([float(int(t in state.tags[f])) for t in ALL_TAGS ])
+        X[i,:len(v)] = v
+
+        for j,fp in enumerate(fs):
+            if f.child(fp):
+                source = {Face: "f",Edge: "e",Vertex: "v"}[f.__class__]
+                destination = {Face: "f",Edge: "e",Vertex: "v"}[fp.__class__]
+                incidence.extend([(i,j),(j,i)])
+                codes.extend([BoundaryEncoder.edgeCode.index(source + "2" + destination),
+                              BoundaryEncoder.edgeCode.index(destination + "2" + source)])
+    return fs, X, incidence, codes
+
+def check(state):
+    fs, X, incidence, codes = reference(state)
+    featurization = Featurization.ofState(state)
+    same = featurization.features == fs and np.array_equal(featurization.X, X)
+    # the pairs come out in a different order
+    same = same and sorted(zip(map(tuple, featurization.incidence.tolist()), featurization.codes.tolist())) == \
+        sorted(zip(incidence, codes))
+    return same
+
+############## Sample code begins ################
+# A small two-solid state: the target is two boxes, the canvas only has the first one.
+box = [(0,0,0), (0,2,0), (2,2,0), (2,0,0)]
+canvas = CAD().extrude(box, (0,0,1))
+target = canvas.extrude([(1,1,1), (1,3,1), (3,3,1), (3,1,1)], (0,0,1))
+
+print_info('Comparing the vectorized featurization with the double loop...')
+state = State(canvas, target)
+ok = check(state)
+# tags go in their own columns
+for n,tag in enumerate(ALL_TAGS):
+    state = state.addTag(state.vertices[n], tag)
+ok = check(state) and ok
+if ok:
+    print_ok('Same features, rows, incidences and codes.')
+else:
+    print_error('The vectorized featurization differs from the double loop.')
@@ -0,0 +1,53 @@
+import random
+
+import torch
+
+from common import print_info, print_error, print_ok
+from geometric import BoundaryEncoder
+
+# sparseForward summarizes the disconnected senders of a feature by their mean, which only gives the same messages
+# as forward when there is at most one of them. These graphs are built so that every feature has at most one.
+def random_graph(size):
+    connected = set()
+    for i in range(size):
+        for j in range(i + 1, size):
+            if random.random() < 0.5: connected.add((i,j))
+    for i in range(size):
+        others = [j for j in range(size) if j != i and (min(i,j),max(i,j)) not in connected ]
+        random.shuffle(others)
+        for j in others[1:]:
+            connected.add((min(i,j),max(i,j)))
+    incidence, codes = [], []
+    for i,j in sorted(connected):
+        incidence.extend([(i,j),(j,i)])
+        codes.extend(random.randrange(len(BoundaryEncoder.edgeCode) - 1) for _ in range(2))
+    return incidence, codes
+
+############## Sample code begins ################
+random.seed(0)
+torch.manual_seed(0)
+H = 16
+m = BoundaryEncoder(layers=2, H=H)
+m.eval()
+
+print_info('Comparing sparseForward with forward on graphs where every feature has at most one disconnected sender...')
+largest = 0.
+with torch.no_grad():
+    for _ in range(20):
+        # several graphs of different sizes at once, so that the graph index is exercised
+        sizes = [random.randint(1,6) for _ in range(random.randint(1,4)) ]
+        es, incidence, codes, graph = [], [], [], []
+        for g,size in enumerate(sizes):
+            e = torch.randn(size, H)
+            i, c = random_graph(size)
+            es.append((e, i, c))
+            incidence.extend((a + len(graph), b + len(graph)) for a,b in i)
+            codes.extend(c)
+            graph.extend([g]*size)
+        sparse = m.sparseForward(torch.cat([e for e,_,_ in es]), incidence, codes, graph)
+        dense = torch.cat([m(e, (i, c)) for e,i,c in es])
+        largest = max(largest, (sparse - dense).abs().max().item())
+if largest < 1e-4:
+    print_ok('Largest difference between encodings:', largest)
+else:
+    print_error('Largest difference between encodings:', largest)
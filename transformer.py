@@ -14,6 +14,11 @@ class Pointer:
     def __ne__(self,o): return not (self == o)
     def __hash__(self): return hash(self.index)
 
+def lengthMask(lengths, L, device=None):
+    """BxL boolean tensor, true at positions 0 .. lengths[b] - 1 of each row, built on the device"""
+    lengths = torch.as_tensor(lengths, device=device)
+    return torch.arange(L, device=device).unsqueeze(0) < lengths.unsqueeze(1)
+
 class PositionalEncoder(Module):
     def __init__(self, d_model, max_seq_len = 80):
         super(PositionalEncoder, self).__init__()
@@ -27,18 +32,23 @@ class PositionalEncoder(Module):
                 pe[pos, i] = math.sin(pos / (10000 ** ((2 * i)/d_model)))
                 pe[pos, i + 1] = math.cos(pos / (10000 ** ((2 * (i + 1))/d_model)))
 
-        self.pe = pe
+        # a plain tensor rather than a buffer, so that state dicts stay the same as before;
+        # forward moves it next to its input the first time they differ
+        self.pe = torch.tensor(pe, dtype=torch.float)
 
         self.finalize()
  
     
-    def forward(self, x):
-        """x: BxLxE"""
+    def forward(self, x, offset=0):
+        """x: BxLxE, holding positions offset .. offset + L - 1"""
         # make embeddings relatively larger
         x = x * math.sqrt(self.d_model)
         #add constant to embedding
         L = x.size(1)
-        pe = self.tensor(self.pe).unsqueeze(0)[:,:L,:]
+        # modules pickled before this was a tensor hold a numpy array
+        if not torch.is_tensor(self.pe) or self.pe.device != x.device or self.pe.dtype != x.dtype:
+            self.pe = torch.as_tensor(self.pe, dtype=x.dtype, device=x.device)
+        pe = self.pe[offset:offset + L].unsqueeze(0)
         return x + pe
     
 class MultiHeadAttention(Module):
@@ -61,22 +71,18 @@ class MultiHeadAttention(Module):
         self.finalize()
 
     @staticmethod
-    def makeAttentionMask(n_entities, n_attended=None, N=None, M=None):
+    def makeAttentionMask(n_entities, n_attended=None, N=None, M=None, device=None):
+        """BxNxM float tensor on the device: 1 where entity i < n_entities[b] may attend to j < n_attended[b]"""
         if n_attended is None:
             n_attended = n_entities
-            M = N or max(n_entities)
+            M = N or int(max(n_entities))
         
-        N = N or max(n_entities)
-        M = M or max(n_attended)
-        B = len(n_entities)
-        assert len(n_attended) == B
+        N = N or int(max(n_entities))
+        M = M or int(max(n_attended))
+        assert len(n_attended) == len(n_entities)
         
-        mask = np.ones((B,N,M))
-        for b,n in enumerate(n_entities):
-            mask[b,n:,:] = 0
-        for b,m in enumerate(n_attended):
-            mask[b,:,m:] = 0
-        return mask
+        mask = lengthMask(n_entities, N, device).unsqueeze(2) & lengthMask(n_attended, M, device).unsqueeze(1)
+        return mask.float()
 
     def _forward(self, entities, n_entities, mask=None):
         """
@@ -100,7 +106,7 @@ class MultiHeadAttention(Module):
 
         # apply the mask, calculating it from n_entities if needed
         if mask is None:
-            mask = self.tensor(MultiHeadAttention.makeAttentionMask(n_entities, N=N))
+            mask = MultiHeadAttention.makeAttentionMask(n_entities, N=N, device=entities.device)
         attention = attention.masked_fill(mask.unsqueeze(1) == 0, NEGATIVEINFINITY)
         attention = F.softmax(attention, dim=-1)
         attention = attention.masked_fill(mask.unsqueeze(1) == 0, 0.)
@@ -129,23 +135,41 @@ class MultiHeadAttention(Module):
         N = entities.size(1) # maximum number of entities
         M = attend_over.size(1) # maximum number of things we can attend over
 
+        # apply the mask, calculating it from n_entities if needed
+        if mask is None:
+            mask = MultiHeadAttention.makeAttentionMask(n_entities, n_attended,
+                                                        N=N, M=M, device=entities.device)
+        k, v = self.project(attend_over)
+        return self.attendProjected(entities, k, v, mask)
+
+    def project(self, attend_over):
+        """keys and values for attending over attend_over (BxMxE), each of size BxHxMxD.
+        They only depend on what is attended over, so decoders can cache them"""
+        B = attend_over.size(0)
+        M = attend_over.size(1)
+        k = self.K(attend_over).view(B, M, self.heads, self.d).transpose(1,2)
+        v = self.V(attend_over).view(B, M, self.heads, self.d).transpose(1,2)
+        return k, v
+
+    def attendProjected(self, entities, k, v, mask=None):
+        """entities: BxNxE, attending over keys and values from project.
+        mask: BxNxM, or None to attend over everything"""
+        B = entities.size(0) # batch size
+        N = entities.size(1) # maximum number of entities
+
         # query, values, and keys should all be of size BxHxExD
         q = self.Q(entities).view(B, N, self.heads, self.d).transpose(1,2)
-        v = self.V(attend_over).view(B, M, self.heads, self.d).transpose(1,2)
-        k = self.K(attend_over).view(B, M, self.heads, self.d).transpose(1,2)
 
         # attention[i,j] = q_i . k_j
         # i.e., amount that object I is attending to object J
         attention = q @ (k.transpose(-2,-1)) / (self.d**0.5)
         # attention has shape [B,H,N,M]
 
-        # apply the mask, calculating it from n_entities if needed
-        if mask is None:
-            mask = self.tensor(MultiHeadAttention.makeAttentionMask(n_entities, n_attended,
-                                                                    N=N, M=M))
-        attention = attention.masked_fill(mask.unsqueeze(1) == 0, NEGATIVEINFINITY)
+        if mask is not None:
+            attention = attention.masked_fill(mask.unsqueeze(1) == 0, NEGATIVEINFINITY)
         attention = F.softmax(attention, dim=-1)
-        attention = attention.masked_fill(mask.unsqueeze(1) == 0, 0.)
+        if mask is not None:
+            attention = attention.masked_fill(mask.unsqueeze(1) == 0, 0.)
 
         # Mix together values
         o = (attention@v).transpose(1,2).contiguous().view(B, N, self.entity_dimensionality)
@@ -186,10 +210,12 @@ class TransformerEncoder(Module):
     def forward(self, x, n_entities, mask=None):
         if mask is None:
             N = x.size(1)
-            mask = self.tensor(MultiHeadAttention.makeAttentionMask(n_entities, N=N))
+            mask = MultiHeadAttention.makeAttentionMask(n_entities, N=N, device=x.device)
         if self.alternate:
             N = x.size(1)
-            alternationMask = self.tensor(MultiHeadAttention.makeAttentionMask(n_entities, N=N))
+            alternationMask = MultiHeadAttention.makeAttentionMask(n_entities, N=N, device=x.device)
+            # padding attends to itself, so that no row of attention is empty (which would give NaN gradients)
+            alternationMask = torch.max(alternationMask, torch.eye(N, device=x.device).unsqueeze(0))
         for li, l in enumerate(self.layers):
             thisMask = mask
             if self.alternate and li%2 == 1:
@@ -223,7 +249,28 @@ class DecoderBlock(Module):
         # all of the decoder and encoder talk to each other
         a = self.input_attention(decoder_objects, n_decoder,
                                  attend_over=encoder_objects,
-                                 n_attended=n_encoder)
+                                 n_attended=n_encoder,
+                                 mask=encoder_mask)
+        decoder_objects = decoder_objects + self.norm_2(a)
+        decoder_objects = decoder_objects + self.norm_3(self.ff(decoder_objects))
+        return decoder_objects
+
+    def step(self, encoder_objects, new_objects, cache):
+        """Decodes objects appended to the sequence, for a batch of one, without decoding the earlier ones again.
+        cache: empty dictionary for the first step, which then remembers the keys and values of everything seen so far.
+        For the first block of a decoder, this gives the same outputs at the new positions as forward on the whole sequence,
+        because its keys and values only depend on the decoder inputs, which do not change as the sequence grows."""
+        k, v = self.output_attention.project(new_objects)
+        if "k" in cache:
+            k = torch.cat([cache["k"], k], 2)
+            v = torch.cat([cache["v"], v], 2)
+        cache["k"], cache["v"] = k, v
+        a = self.output_attention.attendProjected(new_objects, k, v)
+        decoder_objects = new_objects + self.norm_1(a)
+
+        if "encoder" not in cache:
+            cache["encoder"] = self.input_attention.project(encoder_objects)
+        a = self.input_attention.attendProjected(decoder_objects, *cache["encoder"])
         decoder_objects = decoder_objects + self.norm_2(a)
         decoder_objects = decoder_objects + self.norm_3(self.ff(decoder_objects))
         return decoder_objects
@@ -237,14 +284,17 @@ class TransformerDecoder(Module):
                                      hidden_dimensionality=hidden_dimensionality)])
         self.finalize()
 
-    def forward(self, encodedInputs, inputLengths, outputsSoFar, outputLengths):
+    def forward(self, encodedInputs, inputLengths, outputsSoFar, outputLengths,
+                encoder_mask=None, decoder_mask=None):
         """encodedInputs: BxNxE
         outputsSoFar: BxMxL
         outputLengths: B-dimensional tensor whose entries are in [0,N-1]
-        inputLengths: B-dimensional tensor whose entries are in [0,M-1]"""
+        inputLengths: B-dimensional tensor whose entries are in [0,M-1]
+        encoder_mask: BxMxN, decoder_mask: BxMxM; they override the lengths, for instance to make decoding causal"""
         for l in self.layers:
             outputsSoFar = l(encodedInputs, outputsSoFar,
-                             inputLengths, outputLengths)
+                             inputLengths, outputLengths,
+                             encoder_mask=encoder_mask, decoder_mask=decoder_mask)
         return outputsSoFar
 
 class Transformer(Module):
@@ -305,7 +355,33 @@ class Transformer(Module):
 
         assert len(outputs) == B
         outputSizes = [len(ws) for ws in outputs]
-        M = max(outputSizes)
+        Y = self.embedOutputs(outputs, inputEncodings)
+        
+        outputEncodings = self.decoder(inputEncodings, inputSizes, Y, outputSizes)
+
+        # FIXME: Which of the output encodings participates in the calculation of prediction?
+        relevantOutputs = torch.stack([ outputEncodings[b,outputSizes[b] - 1]
+                                        for b in range(B) ])
+        tokenPrediction = self.predictToken(relevantOutputs)
+
+        
+        attentionQueries = self.outputQueries(relevantOutputs)
+        attentionKeys = self.inputKey(inputEncodings)
+        attentionMatrix = (attentionKeys@(attentionQueries.unsqueeze(2))).squeeze(2)
+        attentionMatrix = attentionMatrix/(self.embedding_size**0.5)
+        # Mask
+        pointerMask = lengthMask(inputSizes, N, attentionMatrix.device)
+        attentionMatrix = attentionMatrix.masked_fill(~pointerMask, NEGATIVEINFINITY)
+        attention = F.log_softmax(attentionMatrix, dim=-1)
+            
+        return tokenPrediction, attention
+
+    def embedOutputs(self, outputs, inputEncodings):
+        """outputs: list of list of symbols and `Pointer`s; inputEncodings: BxNxE
+        returns: BxMxE embeddings of the outputs, with the encodings of the inputs that they point to added in"""
+        B = len(outputs)
+        N = inputEncodings.size(1)
+        M = max(len(ws) for ws in outputs)
         Y = [ ["POINTER" if isinstance(w,Pointer) else w for w in ws]
               for ws in outputs ]
         Y = self.embedding(Y)
@@ -319,37 +395,19 @@ class Transformer(Module):
         #             Y[b,m] += inputEncodings[b,o.index]
         pointerIndices = [ [ o.index if isinstance(o,Pointer) else N for o in outputs[b] ] + [N]*(M - len(outputs[b]))
                            for b in range(B) ]
-        inputEncodings_padded = torch.cat([inputEncodings,self.device(torch.zeros(B,1,self.embedding_size))], 1)
+        inputEncodings_padded = torch.cat([inputEncodings,inputEncodings.new_zeros(B,1,self.embedding_size)], 1)
         #inputEncodings_padded: Bx(N+1)xE
         #pointerIndices: BxM, elements living in 0..N
         #pointerInfo: BxMxE. pointerInfo[b,m,e] = inputEncodings_padded[b,pointerIndices[b,m],e]
-        pointerInfo = inputEncodings_padded[torch.arange(B).unsqueeze(-1),torch.tensor(pointerIndices)]
+        pointerInfo = inputEncodings_padded[torch.arange(B, device=Y.device).unsqueeze(-1),
+                                            torch.tensor(pointerIndices, device=Y.device)]
         if False: # check
             for b in range(B):
                 for m in range(M):
                     print(pointerInfo[b,m] == inputEncodings_padded[b,pointerIndices[b][m]])
         
         Y = Y + pointerInfo
-        
-        outputEncodings = self.decoder(inputEncodings, inputSizes, Y, outputSizes)
-
-        # FIXME: Which of the output encodings participates in the calculation of prediction?
-        relevantOutputs = torch.stack([ outputEncodings[b,outputSizes[b] - 1]
-                                        for b in range(B) ])
-        tokenPrediction = self.predictToken(relevantOutputs)
-
-        
-        attentionQueries = self.outputQueries(relevantOutputs)
-        attentionKeys = self.inputKey(inputEncodings)
-        attentionMatrix = (attentionKeys@(attentionQueries.unsqueeze(2))).squeeze(2)
-        attentionMatrix = attentionMatrix/(self.embedding_size**0.5)
-        # Mask
-        pointerMask = np.zeros((B,N))
-        for b,sz in enumerate(inputSizes): pointerMask[b,sz:] = NEGATIVEINFINITY
-        attentionMatrix = attentionMatrix + self.tensor(pointerMask)
-        attention = F.log_softmax(attentionMatrix, dim=-1)
-            
-        return tokenPrediction, attention
+        return Y
 
     def logLikelihood(self, x, y):
         # calculate embeddings of the input and then duplicate for the whole batch
@@ -389,53 +447,86 @@ class Transformer(Module):
             return tokenLikelihood
 
     def batched_logLikelihood(self, xs, ys):
-        assert False, "not working"
-        # calculate embeddings of the input and then duplicate for the whole batch
+        """Sum of logLikelihood(x, y) over the examples, in one teacher-forced pass.
+        The inputs are encoded once, and every prefix of every output is decoded at once under a causal mask.
+        This is the same as decoding each prefix on its own, as logLikelihood does, because the decoder
+        has a single block, whose outputs at a position only depend on the inputs up to that position."""
         X = self.vectorizeInput(xs)
-#        print("input",        print("vectorize",X)
         X = self.positional_input(X)
-#        print("position lysed",X)
         inputSizes = [len(x) for x in xs]
         inputEncodings = self.encoder(X, inputSizes)
-#        print("encoded",X)
+        B = len(xs)
+        N = inputEncodings.size(1)
 
         padded_ys = [ ["START"] + y + ["FINISHED"]
                       for y in ys ]
-        outputs = [padded_y[:n]
-                   for padded_y in padded_ys
-                   for n in range(1,len(padded_y)) ]
-        prediction_targets = [ pt
-                               for padded_y in padded_ys
-                               for pt in padded_y[1:] ]
-        B = len(outputs)
-
-        inputEncodings = torch.cat([ inputEncodings[n].repeat(len(y) + 1,1,1)
-                                       for n,y in enumerate(ys) ],
-                                   0)
-        assert inputEncodings.size(0) == B
-        inputSizes = [isize
-                      for n,y in enumerate(ys)
-                      for isize in [inputSizes[n]]*(len(y) + 1) ]
-                                     
+        outputs = [padded_y[:-1] for padded_y in padded_ys ]
+        prediction_targets = [padded_y[1:] for padded_y in padded_ys ]
         outputSizes = [len(ws) for ws in outputs]
+        M = max(outputSizes)
 
-        predictions, attention = self(inputs=None, outputs=outputs,
-                                      inputEncodings=inputEncodings, inputSizes=inputSizes)
+        Y = self.embedOutputs(outputs, inputEncodings)
+        # position i sees positions 0..i of its own output, and nothing past the end of it
+        # (so padding still sees the first position, and no row of attention is empty)
+        decoderMask = torch.tril(torch.ones(M, M, device=Y.device)).unsqueeze(0) * \
+                      lengthMask(outputSizes, M, Y.device).unsqueeze(1).float()
+        encoderMask = MultiHeadAttention.makeAttentionMask([M]*B, inputSizes, N=M, M=N, device=Y.device)
+        outputEncodings = self.decoder(inputEncodings, inputSizes, Y, outputSizes,
+                                       encoder_mask=encoderMask,
+                                       decoder_mask=decoderMask)
+
+        # which predictions are real, as opposed to padding, and which of those are pointers
+        valid = np.zeros((B,M))
+        tokens = np.zeros((B,M), dtype=np.int64)
+        isPointer = np.zeros((B,M))
+        pointerTargets = np.zeros((B,M), dtype=np.int64)
+        for b,targets in enumerate(prediction_targets):
+            for m,pt in enumerate(targets):
+                valid[b,m] = 1.
+                tokens[b,m] = self.lexicon2index["POINTER" if isinstance(pt,Pointer) else pt]
+                if isinstance(pt,Pointer):
+                    isPointer[b,m] = 1.
+                    pointerTargets[b,m] = pt.index
+
+        predictions = self.predictToken(outputEncodings)
+        tokenLikelihood = (predictions.gather(2,self.tensor(tokens).unsqueeze(2)).squeeze(2)*self.tensor(valid)).sum()
+
+        attentionQueries = self.outputQueries(outputEncodings)
+        attentionKeys = self.inputKey(inputEncodings)
+        attentionMatrix = attentionQueries@(attentionKeys.transpose(1,2))/(self.embedding_size**0.5)
+        # Mask
+        pointerMask = lengthMask(inputSizes, N, attentionMatrix.device).unsqueeze(1)
+        attention = F.log_softmax(attentionMatrix.masked_fill(~pointerMask, NEGATIVEINFINITY), dim=-1)
+        attentionLikelihood = attention.gather(2,self.tensor(pointerTargets).unsqueeze(2)).squeeze(2)*self.tensor(isPointer)
+        attentionLikelihood = attentionLikelihood.sum()
+
+        return attentionLikelihood + tokenLikelihood
+
+    def step(self, y, inputEncodings, cache):
+        """Same as self(inputs=None, outputs=[y], inputEncodings=inputEncodings, inputSizes=[N]) for a single-block decoder,
+        but only decodes the last symbol of y, remembering the others in cache (empty at the start of each sequence)"""
+        m = len(y) - 1
+        w = y[-1]
+        Y = self.embedding([["POINTER" if isinstance(w,Pointer) else w]])
+        if isinstance(self.positional_output, PositionalEncoder):
+            Y = self.positional_output(Y, offset=m)
+        else:
+            Y = self.positional_output(Y)
+        if isinstance(w,Pointer):
+            Y = Y + inputEncodings[:,w.index].unsqueeze(1)
 
-        yh = self.tensor([self.lexicon2index["POINTER" if isinstance(pt,Pointer) else pt]
-                          for pt in prediction_targets])
-        tokenLikelihood = predictions.gather(1,yh.unsqueeze(1)).sum()
+        outputEncodings = self.decoder.layers[0].step(inputEncodings, Y, cache.setdefault("decoder", {}))
+        relevantOutputs = outputEncodings[:,0]
+        tokenPrediction = self.predictToken(relevantOutputs)
 
-        if True:
-            pointerMask = np.array([int(isinstance(pt, Pointer))*1.
-                                    for pt in prediction_targets ])
-            pointerTargets = np.array([pt.index if isinstance(pt, Pointer) else 0
-                                       for pt in prediction_targets ])
-            attentionLikelihood = attention.gather(1,self.tensor(pointerTargets).unsqueeze(1))*self.tensor(pointerMask)
-            attentionLikelihood = attentionLikelihood.sum()
-            return attentionLikelihood + tokenLikelihood
-        else:
-            return tokenLikelihood
+        if "attentionKeys" not in cache:
+            cache["attentionKeys"] = self.inputKey(inputEncodings)
+        attentionQueries = self.outputQueries(relevantOutputs)
+        attentionMatrix = (cache["attentionKeys"]@(attentionQueries.unsqueeze(2))).squeeze(2)
+        attentionMatrix = attentionMatrix/(self.embedding_size**0.5)
+        attention = F.log_softmax(attentionMatrix, dim=-1)
+
+        return tokenPrediction, attention
 
     def sample(self, x, substitutePointers=True):
         """x: list of symbols in lexicon
@@ -448,11 +539,16 @@ class Transformer(Module):
 
         y = ["START"]
         to_return = []
-        
+        # with more than one decoder block, the outputs of the earlier symbols change as the sequence grows
+        incremental = len(self.decoder.layers) == 1
+        cache = {}
 
         while len(y) < 20:
-            prediction, attention = self(inputs=None, outputs=[y],
-                                         inputEncodings=inputEncodings, inputSizes=[len(x)])
+            if incremental:
+                prediction, attention = self.step(y, inputEncodings, cache)
+            else:
+                prediction, attention = self(inputs=None, outputs=[y],
+                                             inputEncodings=inputEncodings, inputSizes=[len(x)])
             prediction = prediction[0]
             attention = attention[0]
             
@@ -544,11 +640,7 @@ if __name__ == "__main__":
             ys.append(y)
         
         m.zero_grad()
-        L = 0.
-        for x,y in zip(xs,ys) :
-            L =- m.logLikelihood(x,y)
-        Lp = -m.batched_logLikelihood(xs,ys)
-        print(L,Lp)
+        L = -m.batched_logLikelihood(xs,ys)
         L.backward()
         totalLosses += L.data.cpu().numpy()
         optimizer.step()
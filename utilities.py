@@ -119,10 +119,12 @@ class LexicalEmbedding(Module):
 
     def forward(self, batch_of_sentences):
         N = max(len(ws) for ws in batch_of_sentences)
-        batch_of_sentences = [ ws + [self.lexicon[0]]*(N - len(ws)) for ws in batch_of_sentences ]
-        batch_of_sentences = [[self.lexicon2index[w] for w in ws]
+        # padding is the first word of the lexicon, which has index 0
+        index = self.lexicon2index
+        batch_of_sentences = [[index[w] for w in ws] + [0]*(N - len(ws))
                               for ws in batch_of_sentences ]
-        return self.embedding(self.tensor(batch_of_sentences))
+        return self.embedding(torch.tensor(batch_of_sentences, dtype=torch.long,
+                                           device=self.embedding.weight.device))
         
 
 class PQ(object):